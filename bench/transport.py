@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Compare small get/put latency over loopback TCP and a UNIX domain socket
+
+By default two on-memory ttservers are started, one on a TCP port and one on
+a UNIX domain socket. Already running servers can be given instead::
+
+    $ python bench/transport.py -n 20000
+    $ python bench/transport.py --tcp 127.0.0.1:1978 --unix /tmp/tt.sock
+
+"""
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+from pytyrant.pytyrant import Tyrant
+from pytyrant import ttserver
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def run(t, name, count, value):
+    results = []
+    for op in ('put', 'get'):
+        samples = []
+        start = time.time()
+        for i in xrange(count):
+            key = 'bench%d' % (i % 1000)
+            begin = time.time()
+            if op == 'put':
+                t.put(key, value)
+            else:
+                t.get(key)
+            samples.append(time.time() - begin)
+        elapsed = time.time() - start
+        samples.sort()
+        results.append((name, op, count / elapsed,
+                        percentile(samples, 0.5) * 1e6,
+                        percentile(samples, 0.99) * 1e6))
+    return results
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--count', type='int', default=10000,
+                      help='requests per operation')
+    parser.add_option('-s', '--size', type='int', default=100,
+                      help='value size in bytes')
+    parser.add_option('--tcp', metavar='HOST:PORT',
+                      help='use a running server over TCP')
+    parser.add_option('--unix', metavar='PATH',
+                      help='use a running server on a UNIX domain socket')
+    parser.add_option('--port', type='int', default=1979,
+                      help='port of the started TCP server')
+    parser.add_option('--exec-cmd', default=ttserver.TT_COMMAND,
+                      help='ttserver command of the started servers')
+    options, args = parser.parse_args(argv)
+
+    servers = []
+    tmpdir = None
+    tcp, unix = options.tcp, options.unix
+    if tcp is None:
+        tt = ttserver.TokyoTyrant(ttserver.TTMemHashDB(), port=options.port,
+                                  exec_cmd=options.exec_cmd)
+        servers.append(tt)
+        tcp = '127.0.0.1:%d' % options.port
+    if unix is None:
+        tmpdir = tempfile.mkdtemp()
+        unix = os.path.join(tmpdir, 'tt.sock')
+        servers.append(ttserver.TokyoTyrant(ttserver.TTMemHashDB(),
+                                            socket_path=unix,
+                                            exec_cmd=options.exec_cmd))
+    try:
+        for tt in servers:
+            tt.run()
+        for tt in servers:
+            tt.wait_ready()
+        host, port = tcp.rsplit(':', 1)
+        value = 'x' * options.size
+        results = []
+        for name, t in (('tcp', Tyrant.open(host, int(port))),
+                        ('unix', Tyrant.open('unix://' + unix))):
+            try:
+                results.extend(run(t, name, options.count, value))
+            finally:
+                t.close()
+    finally:
+        for tt in servers:
+            tt.stop()
+        if tmpdir is not None:
+            if os.path.exists(unix):
+                os.remove(unix)
+            os.rmdir(tmpdir)
+
+    print '%-6s %-4s %10s %10s %10s' % ('', 'op', 'ops/s', 'p50 us',
+                                        'p99 us')
+    for name, op, rate, p50, p99 in results:
+        print '%-6s %-4s %10.0f %10.1f %10.1f' % (name, op, rate, p50, p99)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
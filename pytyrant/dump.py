@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Streaming export and import of Tokyo Tyrant databases
+
+Records are written to a compact, length-prefixed dump file::
+
+    magic      'PTDUMP\\x01'
+    record     >I key length, >I value length, key, value
+    ...
+    trailer    >I 0xffffffff, >Q number of records
+
+Both directions stream with bounded memory: keys are fetched in batches of
+pipelined ``iternext`` requests and their values with one ``getlist`` per
+batch; the importer sends ``putlist`` batches of a bounded size.
+
+An online dump sees concurrent updates. For a consistent snapshot use
+dump_snapshot(), which has the server write a hot copy of its database with
+``copy``, serves that copy from a temporary read-only ttserver and dumps it
+from there. The copy path is interpreted by the server, so this requires the
+server to run on the local host.
+
+    >>> from pytyrant.pytyrant import Tyrant
+    >>> from pytyrant import dump
+    >>> t = Tyrant.open('127.0.0.1', 1978)
+    >>> dump.dump(t, open('/backup/data.ptdump', 'wb'))
+    1000000
+    >>> dump.load(Tyrant.open('127.0.0.1', 1979),
+    ...           open('/backup/data.ptdump', 'rb'))
+    1000000
+
+"""
+import optparse
+import os
+import struct
+import sys
+
+from pytyrant import Tyrant, DEFAULT_PORT, RDBMONOULOG
+import ttserver
+
+__all__ = ['DumpError', 'dump', 'dump_snapshot', 'load', 'iterdump']
+
+MAGIC = 'PTDUMP\x01'
+END = 0xffffffff
+
+
+class DumpError(Exception):
+    pass
+
+
+def iteritems(t, batch_size=1000):
+    """Iterate over all (key, value) pairs in batches
+    """
+    t.iterinit()
+    while True:
+        keys = t.iternext_many(batch_size)
+        if not keys:
+            break
+        rval = t.misc('getlist', 0, keys)
+        # Records removed since their key was seen are simply missing
+        for i in xrange(0, len(rval), 2):
+            yield rval[i], rval[i + 1]
+
+
+def dump(t, fileobj, batch_size=1000):
+    """Write all records of the server t is connected to into fileobj.
+    Returns the number of records written.
+    """
+    fileobj.write(MAGIC)
+    count = 0
+    for k, v in iteritems(t, batch_size):
+        fileobj.write(struct.pack('>II', len(k), len(v)))
+        fileobj.write(k)
+        fileobj.write(v)
+        count += 1
+    fileobj.write(struct.pack('>IQ', END, count))
+    return count
+
+
+def dump_snapshot(t, copy_path, fileobj, port, batch_size=1000,
+                  exec_cmd=ttserver.TT_COMMAND, keep_copy=False):
+    """Dump a consistent snapshot of the database t is connected to.
+
+    copy_path : Path the server hot-copies its database to; the extension
+                has to match the database type, e.g. '.tch'
+    port : Free port for the temporary ttserver serving the copy
+    keep_copy : Don't remove the copy afterwards
+    """
+    t.copy(copy_path)
+    try:
+        server = ttserver.TokyoTyrant(
+            ttserver.db_factory(copy_path, mode=ttserver.TT_READ),
+            hostname='127.0.0.1', port=port, exec_cmd=exec_cmd)
+        server.run()
+        try:
+            server.wait_ready()
+            snapshot = Tyrant.open(*server.endpoint())
+            try:
+                return dump(snapshot, fileobj, batch_size)
+            finally:
+                snapshot.close()
+        finally:
+            server.stop()
+    finally:
+        if not keep_copy and os.path.exists(copy_path):
+            os.remove(copy_path)
+
+
+def _read(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise DumpError('Truncated dump file')
+    return data
+
+
+def iterdump(fileobj):
+    """Iterate over the (key, value) pairs of a dump file
+
+    >>> from StringIO import StringIO
+    >>> class Server(object):
+    ...     # Just enough of a Tyrant connection for dump()
+    ...     def __init__(self, items):
+    ...         self.items = items
+    ...     def iterinit(self):
+    ...         self.keys = sorted(self.items)
+    ...     def iternext_many(self, count):
+    ...         keys, self.keys = self.keys[:count], self.keys[count:]
+    ...         return keys
+    ...     def misc(self, func, opts, keys):
+    ...         return sum([[k, self.items[k]] for k in keys], [])
+    >>> f = StringIO()
+    >>> dump(Server({'a': 'one', 'b': '', 'c': '\\x00' * 3}), f, 2)
+    3
+    >>> data = f.getvalue()
+    >>> list(iterdump(StringIO(data)))
+    [('a', 'one'), ('b', ''), ('c', '\\x00\\x00\\x00')]
+    >>> list(iterdump(StringIO(data[:-3])))
+    Traceback (most recent call last):
+    ...
+    DumpError: Truncated dump file
+    >>> list(iterdump(StringIO(data[:-8] + struct.pack('>Q', 4))))
+    Traceback (most recent call last):
+    ...
+    DumpError: Dump file has 3 records, expected 4
+    """
+    if _read(fileobj, len(MAGIC)) != MAGIC:
+        raise DumpError('Not a dump file')
+    count = 0
+    while True:
+        klen, = struct.unpack('>I', _read(fileobj, 4))
+        if klen == END:
+            expected, = struct.unpack('>Q', _read(fileobj, 8))
+            if expected != count:
+                raise DumpError('Dump file has %d records, expected %d' %
+                                (count, expected))
+            return
+        vlen, = struct.unpack('>I', _read(fileobj, 4))
+        yield _read(fileobj, klen), _read(fileobj, vlen)
+        count += 1
+
+
+def load(t, fileobj, batch_bytes=1 << 20, no_update_log=False):
+    """Store all records of a dump file through t with putlist batches of at
+    most batch_bytes. Returns the number of records stored.
+    """
+    opts = no_update_log and RDBMONOULOG or 0
+    lst, size, count = [], 0, 0
+    for k, v in iterdump(fileobj):
+        lst.extend((k, v))
+        size += len(k) + len(v)
+        count += 1
+        if size >= batch_bytes:
+            t.misc('putlist', opts, lst)
+            lst, size = [], 0
+    if lst:
+        t.misc('putlist', opts, lst)
+    return count
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] dump|load FILE',
+        description='Export a Tokyo Tyrant database into a dump file or '
+                    'import a dump file.')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=DEFAULT_PORT)
+    parser.add_option('--batch-size', type='int', default=1000,
+                      help='keys per batch when dumping')
+    parser.add_option('--snapshot', metavar='COPY_PATH',
+                      help='dump a consistent hot copy written to COPY_PATH')
+    parser.add_option('--snapshot-port', type='int',
+                      help='port of the ttserver serving the hot copy')
+    parser.add_option('--no-update-log', action='store_true')
+    options, args = parser.parse_args(argv)
+    if len(args) != 2 or args[0] not in ('dump', 'load'):
+        parser.error('expected dump or load and a file name')
+    command, path = args
+    if options.snapshot and not options.snapshot_port:
+        parser.error('--snapshot requires --snapshot-port')
+
+    t = Tyrant.open(options.host, options.port)
+    try:
+        if command == 'dump':
+            f = open(path, 'wb')
+            try:
+                if options.snapshot:
+                    count = dump_snapshot(t, options.snapshot, f,
+                                          options.snapshot_port,
+                                          options.batch_size)
+                else:
+                    count = dump(t, f, options.batch_size)
+            finally:
+                f.close()
+        else:
+            f = open(path, 'rb')
+            try:
+                count = load(t, f, no_update_log=options.no_update_log)
+            finally:
+                f.close()
+    finally:
+        t.close()
+    sys.stderr.write('%d records\n' % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Expiring records on top of table databases
+
+Tokyo Tyrant has no native expiry. An ExpiringTable stores the expiry time
+of every record as a column with a decimal index, hides expired records on
+read and removes them with a reaper, run by hand or from a background
+thread::
+
+    >>> from pytyrant.pytyrant import PyTableTyrant
+    >>> from pytyrant.expiry import ExpiringTable
+    >>> sessions = ExpiringTable(PyTableTyrant.open('127.0.0.1', 1978),
+    ...                          ttl=3600)
+    >>> sessions['a1b2'] = {'user': 'john'}
+    >>> sessions.set('c3d4', {'user': 'mary'}, ttl=60)
+    >>> sessions['a1b2']
+    {'user': 'john'}
+    >>> sessions.start_reaper(interval=30)
+
+The reaper finds expired records with an indexed ``expires__lt=now`` search
+limited to batch_size keys, checks them again with one getlist and removes
+those still expired with one outlist, pausing between batches so a large
+backlog is cleaned up without a load spike. A record refreshed between that
+check and the outlist can still be removed.
+
+"""
+import collections
+import threading
+import time
+
+from pytyrant import (RDBITDECIMAL, RDBITKEEP, RDBMONOULOG, TyrantError,
+                      dict_to_list, list_to_dict)
+
+__all__ = ['ExpiringTable']
+
+
+class ExpiringTable(object):
+    """Dict-like wrapper for a PyTableTyrant whose records expire
+
+    ptt : PyTableTyrant
+    ttl : Default lifetime of records in seconds (default=None => records
+          set without a ttl never expire)
+    column : Column holding the expiry time (default='_expires')
+    create_index : Create the decimal index on column unless it exists
+    """
+    def __init__(self, ptt, ttl=None, column='_expires', create_index=True):
+        self.ptt = ptt
+        self.ttl = ttl
+        self.column = column
+        if create_index:
+            try:
+                ptt.setindex(column, RDBITDECIMAL | RDBITKEEP)
+            except TyrantError:
+                # The index exists already
+                pass
+        # Reaper metrics
+        self.reaped = 0
+        self.reap_runs = 0
+        self.reap_errors = 0
+        self.last_reap = None
+        self.batch_latency = collections.deque(maxlen=100)
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _expired(self, record, now=None):
+        expires = record.get(self.column)
+        if expires is None:
+            return False
+        return float(expires) <= (now or time.time())
+
+    def _strip(self, record):
+        record.pop(self.column, None)
+        return record
+
+    def set(self, key, record, ttl=None, no_update_log=False):
+        """Store record for ttl seconds (default=self.ttl)
+        """
+        if ttl is None:
+            ttl = self.ttl
+        record = dict(record)
+        if ttl is not None:
+            record[self.column] = '%.3f' % (time.time() + ttl)
+        else:
+            record.pop(self.column, None)
+        opts = no_update_log and RDBMONOULOG or 0
+        self.ptt._remember(key)
+        self.ptt.t.misc('put', opts, [key] + dict_to_list(record))
+
+    def __setitem__(self, key, record):
+        self.set(key, record)
+
+    def __getitem__(self, key):
+        record = self.ptt[key]
+        if self._expired(record):
+            raise KeyError(key)
+        return self._strip(record)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __delitem__(self, key):
+        del self.ptt[key]
+
+    def multi_get(self, keys):
+        """Records of keys as a dict; missing and expired ones are left out
+        """
+        now = time.time()
+        rval = self.ptt.t.misc('getlist', 0, list(keys))
+        result = {}
+        for i in xrange(0, len(rval), 2):
+            record = _record(rval[i + 1])
+            if not self._expired(record, now):
+                result[rval[i]] = self._strip(record)
+        return result
+
+    def expires(self, key):
+        """Expiry time of key as a timestamp, None if it never expires
+        """
+        expires = self.ptt[key].get(self.column)
+        return expires is not None and float(expires) or None
+
+    def touch(self, key, ttl=None, no_update_log=False):
+        """Extend the lifetime of key to ttl seconds (default=self.ttl) from
+        now. Raises KeyError if the record is missing or expired.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            raise ValueError('No ttl given and the table has no default ttl')
+        record = self.ptt[key]
+        if self._expired(record):
+            raise KeyError(key)
+        record[self.column] = '%.3f' % (time.time() + ttl)
+        opts = no_update_log and RDBMONOULOG or 0
+        self.ptt.t.misc('put', opts, [key] + dict_to_list(record))
+
+    def reap(self, batch_size=1000, pause=0.0, max_batches=None, ptt=None):
+        """Remove expired records in batches of at most batch_size, sleeping
+        pause seconds between batches. Returns the number removed.
+        """
+        if ptt is None:
+            ptt = self.ptt
+        now = time.time()
+        started = now
+        removed = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            if batches and pause:
+                time.sleep(pause)
+            batch_started = time.time()
+            query = ptt.search.filter(**{self.column + '__lt': now})
+            keys = query[:batch_size]
+            if not keys:
+                break
+            # Skip records refreshed since the search
+            rval = ptt.t.misc('getlist', 0, keys)
+            expired = [rval[i] for i in xrange(0, len(rval), 2)
+                       if self._expired(_record(rval[i + 1]), now)]
+            if expired:
+                ptt.t.misc('outlist', 0, expired)
+            removed += len(expired)
+            batches += 1
+            self.batch_latency.append(time.time() - batch_started)
+            if len(keys) < batch_size:
+                break
+        self.reaped += removed
+        self.reap_runs += 1
+        self.last_reap = (started, time.time() - started, removed)
+        return removed
+
+    def metrics(self):
+        """Reaper statistics as a dict
+        """
+        latency = sorted(self.batch_latency)
+        return {
+            'reaped': self.reaped,
+            'runs': self.reap_runs,
+            'errors': self.reap_errors,
+            'last_run': self.last_reap and self.last_reap[0],
+            'last_duration': self.last_reap and self.last_reap[1],
+            'last_reaped': self.last_reap and self.last_reap[2],
+            'batch_latency_max': latency and latency[-1] or 0.0,
+            'batch_latency_median': latency and latency[len(latency) // 2]
+                                    or 0.0,
+        }
+
+    def _run(self, interval, batch_size, pause, max_batches):
+        ptt = self.ptt.clone()
+        try:
+            while not self._stopped.isSet():
+                started = time.time()
+                try:
+                    self.reap(batch_size, pause, max_batches, ptt)
+                except Exception:
+                    self.reap_errors += 1
+                    ptt.t.close()
+                    ptt = self.ptt.clone()
+                self._stopped.wait(max(0, interval - (time.time() - started)))
+        finally:
+            ptt.t.close()
+
+    def start_reaper(self, interval=60.0, batch_size=1000, pause=0.05,
+                     max_batches=None):
+        """Reap every interval seconds from a background thread over a
+        separate connection
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(
+            interval, batch_size, pause, max_batches))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop_reaper(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def _record(value):
+    return list_to_dict(value.split('\x00'))
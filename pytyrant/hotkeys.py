@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""Hot key detection with streaming frequency sketches
+
+A HotKeyTracker attached to a PyTyrant samples the keys of its reads,
+writes and removals. Per operation type ('get', 'put' and 'out') a
+count-min sketch estimates how often every key was seen and how many value
+bytes it moved, and a heap keeps the k most frequent keys. Memory use is
+fixed by the sketch size and k, whatever the number of keys::
+
+    >>> from pytyrant.pytyrant import PyTyrant
+    >>> from pytyrant.hotkeys import HotKeyTracker
+    >>> t = PyTyrant.open('127.0.0.1', 1978)
+    >>> t.hotkeys = HotKeyTracker(sample_rate=0.05)
+    ...
+    >>> t.hotkeys.top('get', 3)
+    [('config', 1520.0, 25.3, 3040000.0), ...]
+    >>> t.hotkeys.suggest_pins(max_bytes=1 << 20)
+    ['config', 'front_page']
+
+Estimates are scaled by the sample rate and never lower than the sampled
+counts; the count-min sketch can only overestimate. Rates are per second
+since the tracker was created or reset.
+
+"""
+import array
+import hashlib
+import heapq
+import random
+import struct
+import threading
+import time
+
+__all__ = ['CountMinSketch', 'TopK', 'HotKeyTracker']
+
+
+class CountMinSketch(object):
+    """Approximate counts of keys in depth rows of width counters
+
+    Estimates are never lower than the true counts:
+
+    >>> sketch = CountMinSketch(width=64, depth=3)
+    >>> sketch.add('a'), sketch.add('a', 4)
+    (1.0, 5.0)
+    >>> for i in xrange(100):
+    ...     n = sketch.add('key%d' % i)
+    >>> sketch.estimate('a') >= 5, sketch.estimate('key1') >= 1
+    (True, True)
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array('d', [0.0]) * width for i in xrange(depth)]
+
+    def _indexes(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(str(key)).digest())
+        return [(h1 + i * h2) % self.width for i in xrange(self.depth)]
+
+    def add(self, key, count=1):
+        """Add count to key; returns the new estimate
+        """
+        estimate = None
+        for row, i in zip(self.rows, self._indexes(key)):
+            row[i] += count
+            if estimate is None or row[i] < estimate:
+                estimate = row[i]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+
+class TopK(object):
+    """The k keys with the largest counts reported to update()
+
+    >>> top = TopK(2)
+    >>> top.update('a', 1)
+    >>> top.update('b', 5)
+    >>> top.update('c', 3)    # replaces 'a'
+    >>> top.update('a', 2)    # too small
+    >>> top.update('c', 9)
+    >>> top.items(), top.min()
+    ([('c', 9), ('b', 5)], 5)
+    """
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self._heap = []
+
+    def update(self, key, count):
+        if key in self.counts or len(self.counts) < self.k:
+            self.counts[key] = count
+            heapq.heappush(self._heap, (count, key))
+        elif count > self.min():
+            smallest = heapq.heappop(self._heap)[1]
+            del self.counts[smallest]
+            self.counts[key] = count
+            heapq.heappush(self._heap, (count, key))
+        if len(self._heap) > 4 * self.k:
+            # Drop the outdated entries of updated keys
+            self._heap = [(c, key) for key, c in self.counts.iteritems()]
+            heapq.heapify(self._heap)
+
+    def min(self):
+        heap = self._heap
+        # Entries of keys updated since are outdated
+        while heap and self.counts.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap and heap[0][0] or 0
+
+    def items(self):
+        """(key, count) pairs, largest count first
+        """
+        return sorted(self.counts.iteritems(), key=lambda i: i[1],
+                      reverse=True)
+
+
+class HotKeyTracker(object):
+    """Sample keys per operation type into count-min sketches and top-k heaps
+
+    sample_rate : Fraction of the operations looked at (default=0.01)
+    k : Number of top keys kept per operation type (default=20)
+    width, depth : Size of every count-min sketch (default=2048 x 4)
+    """
+    def __init__(self, sample_rate=0.01, k=20, width=2048, depth=4):
+        self.sample_rate = sample_rate
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.ops = {}
+            self.sampled = 0
+            self.started = time.time()
+
+    def sample(self):
+        """Whether to record the next operation
+        """
+        return random.random() < self.sample_rate
+
+    def record(self, op, key, size=0):
+        """Count one sampled operation op on key that moved size bytes
+        """
+        with self._lock:
+            state = self.ops.get(op)
+            if state is None:
+                state = self.ops[op] = (
+                    CountMinSketch(self.width, self.depth),
+                    CountMinSketch(self.width, self.depth), TopK(self.k))
+            counts, sizes, top = state
+            top.update(key, counts.add(key))
+            if size:
+                sizes.add(key, size)
+            self.sampled += 1
+
+    def top(self, op=None, n=10):
+        """The n most frequent keys of operation type op (default=None =>
+        all types together) as (key, estimated operations, operations per
+        second, estimated bytes) tuples
+        """
+        with self._lock:
+            if op is None:
+                states = self.ops.values()
+            elif op in self.ops:
+                states = [self.ops[op]]
+            else:
+                states = []
+            candidates = set()
+            for counts, sizes, top in states:
+                candidates.update(top.counts)
+            scale = 1.0 / self.sample_rate
+            elapsed = max(time.time() - self.started, 1e-9)
+            result = []
+            for key in candidates:
+                count = sum(c.estimate(key) for c, s, t in states) * scale
+                size = sum(s.estimate(key) for c, s, t in states) * scale
+                result.append((key, count, count / elapsed, size))
+        result.sort(key=lambda r: r[1], reverse=True)
+        return result[:n]
+
+    def total(self, op=None):
+        """Estimated number of operations of type op (default=all)
+        """
+        with self._lock:
+            if op is None:
+                states = self.ops.values()
+            else:
+                states = [self.ops[op]] if op in self.ops else []
+            # Every sampled operation adds 1 to each row of the sketch
+            return sum(sum(c.rows[0]) for c, s, t in states) / self.sample_rate
+
+    def suggest_pins(self, op='get', min_share=0.01, max_bytes=None, n=None):
+        """Keys worth pinning in a local cache: the most read keys with at
+        least min_share of all operations of type op, while their average
+        value sizes add up to at most max_bytes (default=None => no limit)
+        """
+        total = self.total(op)
+        if not total:
+            return []
+        keys = []
+        budget = max_bytes
+        for key, count, rate, size in self.top(op, n or self.k):
+            if count / total < min_share:
+                break
+            if budget is not None:
+                value_size = count and size / count or 0
+                if value_size > budget:
+                    continue
+                budget -= value_size
+            keys.append(key)
+        return keys
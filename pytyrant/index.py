@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Client-maintained secondary indexes for hash databases
+
+An IndexedTyrant wraps a PyTyrant and keeps inverted index entries for
+attributes computed from the values by Python functions. Every entry is an
+empty record under a per-value prefixed key::
+
+    <namespace><index name>\\x00<attribute value>\\x00<record key>
+
+so adding and removing entries never rewrites a shared key list, and a
+lookup is a single ``fwmkeys`` for the prefix followed by batched
+``getlist`` requests for the records::
+
+    >>> import json
+    >>> from pytyrant.pytyrant import PyTyrant
+    >>> from pytyrant.index import IndexedTyrant
+    >>> users = IndexedTyrant(PyTyrant.open('127.0.0.1', 1978), {
+    ...     'city': lambda v: json.loads(v)['city'],
+    ... })
+    >>> users['john'] = json.dumps({'city': 'Paris'})
+    >>> users.lookup('city', 'Paris')
+    ['john']
+    >>> users.find('city', 'Paris')
+    {'john': '{"city": "Paris"}'}
+
+Entries are kept in the data database by default and hidden from the
+iteration of the wrapper. On a hash database fwmkeys scans all keys on the
+server, so for large datasets pass a PyTyrant of a separate B+ tree server
+as index_db, where a lookup is a range read.
+
+Only writes made through the wrapper update the index. rebuild() recreates
+all entries from a full scan of the data.
+
+"""
+import UserDict
+
+from pytyrant import RDBMONOULOG, TyrantError
+
+__all__ = ['IndexedTyrant']
+
+
+class IndexedTyrant(object, UserDict.DictMixin):
+    """Dict-like wrapper for a PyTyrant maintaining secondary indexes
+
+    pt : PyTyrant holding the records
+    indexes : {name: function} dict; the function returns the attribute of
+              a value, a list of attributes, or None to leave the value out
+    index_db : PyTyrant holding the index entries (default=pt)
+    namespace : Prefix of all index entry keys (default='\\x00idx\\x00')
+    """
+    def __init__(self, pt, indexes, index_db=None, namespace='\x00idx\x00'):
+        self.pt = pt
+        self.indexes = dict(indexes)
+        if index_db is None:
+            index_db = pt
+        self.index_db = index_db
+        self.namespace = namespace
+        self._shared = self.index_db.t is pt.t
+
+    def _prefix(self, name, attr):
+        if '\x00' in attr:
+            raise ValueError('Indexed attributes cannot contain \\x00')
+        return '%s%s\x00%s\x00' % (self.namespace, name, attr)
+
+    def _entries(self, key, value):
+        """Index entry keys of a record
+        """
+        entries = []
+        if value is None:
+            return entries
+        for name, func in self.indexes.iteritems():
+            attrs = func(value)
+            if attrs is None:
+                continue
+            if isinstance(attrs, basestring):
+                attrs = [attrs]
+            for attr in attrs:
+                entries.append(self._prefix(name, str(attr)) + key)
+        return entries
+
+    def _old_values(self, keys):
+        rval = self.pt.t.misc('getlist', 0, keys)
+        return dict((rval[i], rval[i + 1]) for i in xrange(0, len(rval), 2))
+
+    def _write(self, items, opts=0):
+        old = self._old_values([k for k, v in items])
+        stale, fresh, records = [], [], []
+        for key, value in items:
+            previous = set(self._entries(key, old.get(key)))
+            current = set(self._entries(key, value))
+            stale.extend(previous - current)
+            for entry in current - previous:
+                fresh.extend((entry, ''))
+            records.extend((key, value))
+            self.pt._remember(key)
+        if stale:
+            self.index_db.t.misc('outlist', opts, stale)
+        if self._shared:
+            self.pt.t.misc('putlist', opts, fresh + records)
+        else:
+            if fresh:
+                self.index_db.t.misc('putlist', opts, fresh)
+            self.pt.t.misc('putlist', opts, records)
+
+    def __setitem__(self, key, value):
+        self._write([(key, value)])
+
+    def multi_set(self, items, no_update_log=False):
+        opts = (no_update_log and RDBMONOULOG or 0)
+        items = list(items)
+        if items:
+            self._write(items, opts)
+
+    def __getitem__(self, key):
+        if key.startswith(self.namespace) and self._shared:
+            raise KeyError(key)
+        return self.pt[key]
+
+    def multi_get(self, keys, no_update_log=False):
+        return self.pt.multi_get(keys, no_update_log)
+
+    def __delitem__(self, key):
+        self.multi_del([key], missing_ok=False)
+
+    def multi_del(self, keys, no_update_log=False, missing_ok=True):
+        opts = (no_update_log and RDBMONOULOG or 0)
+        keys = list(keys)
+        old = self._old_values(keys)
+        if not missing_ok and len(old) < len(keys):
+            raise KeyError([k for k in keys if k not in old][0])
+        stale = []
+        for key, value in old.iteritems():
+            stale.extend(self._entries(key, value))
+        if self._shared:
+            self.pt.t.misc('outlist', opts, stale + keys)
+        else:
+            if stale:
+                self.index_db.t.misc('outlist', opts, stale)
+            self.pt.t.misc('outlist', opts, keys)
+
+    def __contains__(self, key):
+        if key.startswith(self.namespace) and self._shared:
+            return False
+        return key in self.pt
+
+    def iterkeys(self):
+        for key in self.pt.iterkeys():
+            if not (self._shared and key.startswith(self.namespace)):
+                yield key
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def lookup(self, name, attr):
+        """Keys of the records whose index name contains attr
+        """
+        if name not in self.indexes:
+            raise KeyError(name)
+        prefix = self._prefix(name, str(attr))
+        return [k[len(prefix):] for k in self.index_db.prefix_keys(prefix)]
+
+    def find(self, name, attr, batch_size=1000):
+        """Records whose index name contains attr as a {key: value} dict,
+        fetched with one getlist per batch_size keys. Stale entries of
+        records changed by other clients are skipped.
+        """
+        keys = self.lookup(name, attr)
+        func = self.indexes[name]
+        result = {}
+        for i in xrange(0, len(keys), batch_size):
+            rval = self.pt.t.misc('getlist', 0, keys[i:i + batch_size])
+            for j in xrange(0, len(rval), 2):
+                attrs = func(rval[j + 1])
+                if isinstance(attrs, basestring):
+                    attrs = [attrs]
+                if attrs is not None and str(attr) in map(str, attrs):
+                    result[rval[j]] = rval[j + 1]
+        return result
+
+    def count(self, name, attr):
+        return len(self.lookup(name, attr))
+
+    def rebuild(self, batch_size=1000, no_update_log=False, progress=None):
+        """Drop all index entries and recreate them from a full scan of the
+        records. progress is called with the number of records indexed so
+        far. Returns the number of records indexed.
+        """
+        opts = (no_update_log and RDBMONOULOG or 0)
+        self.index_db.delete_prefix(self.namespace, batch_size,
+                                    no_update_log)
+        t = self.pt.t
+        count = 0
+        t.iterinit()
+        while True:
+            keys = t.iternext_many(batch_size)
+            if not keys:
+                break
+            if self._shared:
+                keys = [k for k in keys if not k.startswith(self.namespace)]
+            if not keys:
+                continue
+            rval = t.misc('getlist', 0, keys)
+            entries = []
+            for i in xrange(0, len(rval), 2):
+                for entry in self._entries(rval[i], rval[i + 1]):
+                    entries.extend((entry, ''))
+            if entries:
+                # Entries written to the scanned database are skipped above
+                self.index_db.t.misc('putlist', opts, entries)
+            count += len(rval) // 2
+            if progress is not None:
+                progress(count)
+        return count
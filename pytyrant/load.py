@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Parallel bulk loader for CSV and JSON lines files
+
+Streams the input file and writes it through several connections in
+parallel, each sending bounded ``putlist`` batches. Table databases get
+every row as a table record (all columns except the key), hash databases
+store one column, or the whole JSON object, as the value::
+
+    $ pytyrant-load --table --key id --index age:decimal users.jsonl
+    $ pytyrant-load --key url --value body --connections 8 pages.csv
+
+Column indexes given with --index are created after the load, which is much
+faster than maintaining them during it. With --checkpoint the number of rows
+stored so far is saved regularly, and a restarted load skips them.
+
+"""
+import csv
+import itertools
+import json
+import optparse
+import os
+import Queue
+import sys
+import threading
+import time
+
+from pytyrant import (Tyrant, DEFAULT_PORT, RDBMONOULOG, RDBITLEXICAL,
+                      RDBITDECIMAL, dict_to_record)
+
+__all__ = ['Loader', 'main']
+
+INDEX_TYPES = {
+    'lexical': RDBITLEXICAL,
+    'decimal': RDBITDECIMAL,
+}
+
+
+def read_csv(fileobj):
+    return csv.DictReader(fileobj)
+
+
+def read_jsonl(fileobj):
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, long, float)):
+        return repr(value)
+    return json.dumps(value)
+
+
+class Loader(object):
+    """Write rows to a server through several connections in parallel
+
+    address : (host, port) of the server
+    key : Name of the column holding the record key
+    value : Column stored as the value in a hash database (default=None
+            => the whole row as JSON)
+    table : Store rows as table records
+    connections : Number of parallel connections (default=4)
+    batch_size : Maximum rows per putlist (default=1000)
+    batch_bytes : Maximum bytes per putlist (default=1MB)
+    no_update_log : Don't write the load to the update log
+    checkpoint : Path of the checkpoint file (default=None => Disabled)
+    """
+    def __init__(self, address, key, value=None, table=False, connections=4,
+                 batch_size=1000, batch_bytes=1 << 20, no_update_log=False,
+                 checkpoint=None):
+        self.address = address
+        self.key = key
+        self.value = value
+        self.table = table
+        self.connections = connections
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.opts = no_update_log and RDBMONOULOG or 0
+        self.checkpoint = checkpoint
+        self.rows = 0
+        self.skipped = 0
+        self.started = None
+
+    def encode(self, row):
+        key = to_str(row[self.key])
+        if self.table:
+            record = dict((to_str(k), to_str(v)) for k, v in row.iteritems()
+                          if k != self.key and v is not None)
+            return key, dict_to_record(record)
+        if self.value is None:
+            return key, json.dumps(row)
+        return key, to_str(row[self.value])
+
+    def batches(self, rows):
+        """Group encoded rows into (row count, putlist arguments) batches
+        """
+        lst, count, size = [], 0, 0
+        for row in rows:
+            k, v = self.encode(row)
+            lst.extend((k, v))
+            count += 1
+            size += len(k) + len(v)
+            if count >= self.batch_size or size >= self.batch_bytes:
+                yield count, lst
+                lst, count, size = [], 0, 0
+        if count:
+            yield count, lst
+
+    def read_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return 0
+        f = open(self.checkpoint)
+        try:
+            return json.load(f)['rows']
+        finally:
+            f.close()
+
+    def write_checkpoint(self, rows):
+        if not self.checkpoint:
+            return
+        tmp = self.checkpoint + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump({'rows': rows}, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.checkpoint)
+
+    def _worker(self, t, todo, done):
+        try:
+            while True:
+                job = todo.get()
+                if job is None:
+                    break
+                seq, count, lst = job
+                try:
+                    t.misc('putlist', self.opts, lst)
+                except Exception, e:
+                    done.put((seq, count, e))
+                else:
+                    done.put((seq, count, None))
+        finally:
+            t.close()
+
+    def load(self, rows, progress=None, progress_interval=5.0):
+        """Store all rows; returns the number of rows stored.
+
+        rows : Iterable of dicts
+        progress : Called as progress(rows_stored, rows_per_second) at most
+                   every progress_interval seconds
+        """
+        skip = self.read_checkpoint()
+        self.rows = self.skipped = skip
+        self.started = time.time()
+        if skip:
+            rows = itertools.islice(rows, skip, None)
+        connections = [Tyrant.open(*self.address)
+                       for i in xrange(self.connections)]
+        todo = Queue.Queue(2 * self.connections)
+        done = Queue.Queue()
+        workers = [threading.Thread(target=self._worker, args=(t, todo, done))
+                   for t in connections]
+        for w in workers:
+            w.setDaemon(True)
+            w.start()
+
+        # Batches finish out of order: only rows of an unbroken sequence of
+        # finished batches count as stored for the checkpoint.
+        finished = {}
+        state = {'next': 0, 'pending': 0, 'reported': time.time()}
+        errors = []
+
+        def collect(block):
+            while state['pending']:
+                try:
+                    seq, count, error = done.get(block)
+                except Queue.Empty:
+                    return
+                block = False
+                state['pending'] -= 1
+                if error is not None:
+                    errors.append(error)
+                    continue
+                finished[seq] = count
+                advanced = False
+                while state['next'] in finished:
+                    self.rows += finished.pop(state['next'])
+                    state['next'] += 1
+                    advanced = True
+                if advanced:
+                    self.write_checkpoint(self.rows)
+                now = time.time()
+                if progress and now - state['reported'] >= progress_interval:
+                    state['reported'] = now
+                    progress(self.rows, self.rate())
+
+        try:
+            for seq, (count, lst) in enumerate(self.batches(rows)):
+                while True:
+                    collect(False)
+                    if errors:
+                        raise errors[0]
+                    try:
+                        todo.put((seq, count, lst), True, 0.1)
+                        break
+                    except Queue.Full:
+                        pass
+                state['pending'] += 1
+            while state['pending']:
+                collect(True)
+            if errors:
+                raise errors[0]
+        finally:
+            for w in workers:
+                todo.put(None)
+            for w in workers:
+                w.join()
+        if progress:
+            progress(self.rows, self.rate())
+        return self.rows
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return elapsed > 0 and (self.rows - self.skipped) / elapsed or 0.0
+
+    def setindex(self, column, index_type=RDBITLEXICAL):
+        t = Tyrant.open(*self.address)
+        try:
+            t.misc('setindex', self.opts, (column, str(index_type)))
+        finally:
+            t.close()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] FILE',
+        description='Bulk load a CSV or JSON lines file into Tokyo Tyrant.')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=DEFAULT_PORT)
+    parser.add_option('--format', choices=sorted(READERS),
+                      help='input format (default: from the file extension)')
+    parser.add_option('--key', help='column holding the record key')
+    parser.add_option('--value', help='column stored as the value '
+                      '(hash databases, default: the whole row as JSON)')
+    parser.add_option('--table', action='store_true',
+                      help='store rows as table records')
+    parser.add_option('--index', action='append', default=[],
+                      metavar='COLUMN[:lexical|decimal]',
+                      help='create a column index after the load')
+    parser.add_option('--connections', type='int', default=4)
+    parser.add_option('--batch-size', type='int', default=1000)
+    parser.add_option('--no-update-log', action='store_true')
+    parser.add_option('--checkpoint', help='checkpoint file to resume from')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected one input file')
+    if not options.key:
+        parser.error('--key is required')
+    path = args[0]
+    fmt = options.format or path.rsplit('.', 1)[-1].lower()
+    if fmt not in READERS:
+        parser.error('unknown input format %r, use --format' % fmt)
+    indexes = []
+    for spec in options.index:
+        column, _, kind = spec.partition(':')
+        if (kind or 'lexical') not in INDEX_TYPES:
+            parser.error('unknown index type %r' % kind)
+        indexes.append((column, INDEX_TYPES[kind or 'lexical']))
+
+    loader = Loader((options.host, options.port), options.key,
+                    value=options.value, table=options.table,
+                    connections=options.connections,
+                    batch_size=options.batch_size,
+                    no_update_log=options.no_update_log,
+                    checkpoint=options.checkpoint)
+
+    def progress(rows, rate):
+        sys.stderr.write('%d rows, %.0f rows/s\n' % (rows, rate))
+
+    f = open(path, 'rb')
+    try:
+        loader.load(READERS[fmt](f), progress)
+    finally:
+        f.close()
+    for column, index_type in indexes:
+        sys.stderr.write('creating index on %s\n' % column)
+        loader.setindex(column, index_type)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
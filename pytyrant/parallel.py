@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Work on query results and key-space partitions in a process pool
+
+Query.aggregate() is built from the pieces here. A table search is cut into
+pages of a stable order with ``setlimit``; every worker process opens its
+own connection and handles every n-th page, so neither the keys nor the
+records of the whole result are ever held in one place::
+
+    >>> from pytyrant.pytyrant import PyTableTyrant
+    >>> t = PyTableTyrant.open('127.0.0.1', 1978)
+    >>> t.search.filter(age__gt=30).aggregate(group_by='city',
+    ...     sum=['score'], max=['age'], processes=4)
+    {'Paris': {'count': 2, 'score__sum': 91.0, 'age__max': 45.0}}
+
+Every page is a search of its own, so the server sorts the result once per
+page; choose page_size large enough to keep their number small.
+
+parallel_scan() runs a function over disjoint partitions of the key space
+in worker processes, again each with its own connection, and streams the
+results back through a bounded queue. Partitions are sets of key prefixes
+(fwmkeys), key ranges of B+ tree databases (range) or table searches::
+
+    >>> from pytyrant.parallel import parallel_scan, range_partitions
+    >>> def big(records):
+    ...     for key, value in records:
+    ...         if len(value) > 1000:
+    ...             yield key
+    >>> for key in parallel_scan(t.t.address(), big,
+    ...                          range_partitions(['g', 'n', 't'])):
+    ...     print key
+
+"""
+import multiprocessing
+import Queue
+import traceback
+
+from pytyrant import Tyrant, list_to_dict
+
+__all__ = ['Aggregate', 'aggregate_pages', 'aggregate_parallel',
+           'PrefixPartition', 'RangePartition', 'QueryPartition',
+           'prefix_partitions', 'range_partitions', 'query_partitions',
+           'parallel_scan']
+
+
+class Aggregate(object):
+    """Partial aggregation results that can be merged
+
+    group_by : field or tuple of fields (default=None => one group)
+    sum, min, max : fields aggregated as numbers
+    count : count the records of every group
+    """
+    def __init__(self, group_by=None, sum=(), min=(), max=(), count=True):
+        self.group_by = group_by
+        self.sum = tuple(sum)
+        self.min = tuple(min)
+        self.max = tuple(max)
+        self.count = count
+        self.groups = {}
+
+    def fields(self):
+        """The columns that have to be decoded
+        """
+        fields = set(self.sum + self.min + self.max)
+        if isinstance(self.group_by, tuple):
+            fields.update(self.group_by)
+        elif self.group_by is not None:
+            fields.add(self.group_by)
+        return fields
+
+    def empty(self):
+        return self.__class__(self.group_by, self.sum, self.min, self.max,
+                              self.count)
+
+    def _group(self, row):
+        if self.group_by is None:
+            return None
+        if isinstance(self.group_by, tuple):
+            return tuple(row.get(f) for f in self.group_by)
+        return row.get(self.group_by)
+
+    def add(self, row):
+        """Add a record given as a dict of (at least) the needed fields
+        """
+        group = self._group(row)
+        state = self.groups.get(group)
+        if state is None:
+            state = self.groups[group] = [0, {}, {}, {}]
+        state[0] += 1
+        sums, mins, maxs = state[1:]
+        for field in self.sum:
+            value = _number(row.get(field))
+            if value is not None:
+                sums[field] = sums.get(field, 0) + value
+        for field in self.min:
+            value = _number(row.get(field))
+            if value is not None and (field not in mins or
+                                      value < mins[field]):
+                mins[field] = value
+        for field in self.max:
+            value = _number(row.get(field))
+            if value is not None and (field not in maxs or
+                                      value > maxs[field]):
+                maxs[field] = value
+
+    def merge(self, other):
+        """Add the partial results of other
+
+        >>> a = Aggregate('city', sum=['score'], max=['age'])
+        >>> b = a.empty()
+        >>> a.add({'city': 'Paris', 'score': '40', 'age': '30'})
+        >>> b.add({'city': 'Paris', 'score': '51', 'age': '45'})
+        >>> b.add({'city': 'Rome', 'score': 'n/a', 'age': '22'})
+        >>> a.merge(b)
+        >>> sorted(a.result()['Paris'].items())
+        [('age__max', 45.0), ('count', 2), ('score__sum', 91.0)]
+        >>> sorted(a.result()['Rome'].items())
+        [('age__max', 22.0), ('count', 1), ('score__sum', None)]
+        """
+        for group, (count, sums, mins, maxs) in other.groups.iteritems():
+            state = self.groups.get(group)
+            if state is None:
+                self.groups[group] = [count, dict(sums), dict(mins),
+                                      dict(maxs)]
+                continue
+            state[0] += count
+            for field, value in sums.iteritems():
+                state[1][field] = state[1].get(field, 0) + value
+            for field, value in mins.iteritems():
+                if field not in state[2] or value < state[2][field]:
+                    state[2][field] = value
+            for field, value in maxs.iteritems():
+                if field not in state[3] or value > state[3][field]:
+                    state[3][field] = value
+
+    def result(self):
+        """{group: {name: value}} or, without group_by, one {name: value}
+        dict. Names are 'count' and field__sum, field__min and field__max.
+        """
+        if self.group_by is None:
+            return self._values(self.groups.get(None, [0, {}, {}, {}]))
+        return dict((group, self._values(state))
+                    for group, state in self.groups.iteritems())
+
+    def _values(self, state):
+        count, sums, mins, maxs = state
+        r = {}
+        if self.count:
+            r['count'] = count
+        for suffix, fields, values in (('sum', self.sum, sums),
+                                       ('min', self.min, mins),
+                                       ('max', self.max, maxs)):
+            for field in fields:
+                r['%s__%s' % (field, suffix)] = values.get(field)
+        return r
+
+
+def _number(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def iter_pages(t, conditions, first_page, stride, page_size):
+    """Yield the key lists of every stride-th page of a search, starting
+    with page first_page
+    """
+    page = first_page
+    while True:
+        limit = '\x00'.join(('setlimit', str(page_size),
+                             str(page * page_size)))
+        keys = t.misc('search', 0, conditions + [limit])
+        if keys:
+            yield keys
+        if len(keys) < page_size:
+            return
+        page += stride
+
+
+def iter_rows(t, keys, fields, batch_size):
+    """Yield the records of keys as dicts of only the given fields, the
+    primary key included as ''
+    """
+    for first in xrange(0, len(keys), batch_size):
+        rval = t.misc('getlist', 0, keys[first:first + batch_size])
+        for i in xrange(0, len(rval), 2):
+            row = {'': rval[i]}
+            parts = rval[i + 1].split('\x00')
+            for j in xrange(0, len(parts) - 1, 2):
+                if parts[j] in fields:
+                    row[parts[j]] = parts[j + 1]
+            yield row
+
+
+def aggregate_pages(t, conditions, agg, first_page, stride, page_size,
+                    batch_size):
+    """Add the records of every stride-th page of a search to agg
+    """
+    fields = agg.fields()
+    for keys in iter_pages(t, conditions, first_page, stride, page_size):
+        for row in iter_rows(t, keys, fields, batch_size):
+            agg.add(row)
+    return agg
+
+
+def _aggregate_worker(args):
+    address, conditions, agg, first_page, stride, page_size, batch_size = args
+    t = Tyrant.open(*address)
+    try:
+        return aggregate_pages(t, conditions, agg, first_page, stride,
+                               page_size, batch_size)
+    finally:
+        t.close()
+
+
+def aggregate_parallel(address, conditions, agg, processes, page_size,
+                       batch_size):
+    """Aggregate a search with processes workers, each connecting to
+    address on its own, and return the merged Aggregate
+    """
+    tasks = [(address, conditions, agg.empty(), i, processes, page_size,
+              batch_size) for i in xrange(processes)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        partials = pool.map(_aggregate_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    result = agg.empty()
+    for partial in partials:
+        result.merge(partial)
+    return result
+
+
+class PrefixPartition(object):
+    """The records whose key starts with one of prefixes
+    """
+    def __init__(self, prefixes):
+        self.prefixes = list(prefixes)
+
+    def __repr__(self):
+        return '<PrefixPartition %r>' % (self.prefixes,)
+
+    def records(self, t, batch_size):
+        for prefix in self.prefixes:
+            keys = t.fwmkeys(prefix, 0xffffffff)
+            for first in xrange(0, len(keys), batch_size):
+                rval = t.misc('getlist', 0, keys[first:first + batch_size])
+                for i in xrange(0, len(rval), 2):
+                    yield rval[i], rval[i + 1]
+
+
+class RangePartition(object):
+    """The records of a B+ tree database with start <= key < stop; None is
+    unbounded
+    """
+    def __init__(self, start=None, stop=None):
+        self.start = start
+        self.stop = stop
+
+    def __repr__(self):
+        return '<RangePartition %r-%r>' % (self.start, self.stop)
+
+    def records(self, t, batch_size):
+        start = self.start or ''
+        while True:
+            args = [start, str(batch_size)]
+            if self.stop is not None:
+                args.append(self.stop)
+            page = t.misc('range', 0, args)
+            for i in xrange(0, len(page), 2):
+                yield page[i], page[i + 1]
+            if len(page) < 2 * batch_size:
+                return
+            start = page[-2] + '\x00'
+
+
+class QueryPartition(object):
+    """The records of a table search given by its conditions (see
+    Query.conditions); values are decoded into dicts
+    """
+    def __init__(self, conditions):
+        self.conditions = list(conditions)
+
+    def __repr__(self):
+        return '<QueryPartition %r>' % (self.conditions,)
+
+    def records(self, t, batch_size):
+        keys = t.misc('search', 0, self.conditions)
+        for first in xrange(0, len(keys), batch_size):
+            rval = t.misc('getlist', 0, keys[first:first + batch_size])
+            for i in xrange(0, len(rval), 2):
+                yield rval[i], list_to_dict(rval[i + 1].split('\x00'))
+
+
+def prefix_partitions(prefixes, count):
+    """Spread prefixes over count PrefixPartitions
+    """
+    prefixes = list(prefixes)
+    return [PrefixPartition(prefixes[i::count]) for i in xrange(count)
+            if prefixes[i::count]]
+
+
+def range_partitions(boundaries):
+    """RangePartitions covering all keys, split at the sorted boundaries
+    """
+    edges = [None] + sorted(boundaries) + [None]
+    return [RangePartition(edges[i], edges[i + 1])
+            for i in xrange(len(edges) - 1)]
+
+
+def query_partitions(query, column, boundaries):
+    """QueryPartitions of query, split at the sorted numeric boundaries of
+    column. Records without a numeric value in column are in none of them.
+    """
+    edges = [None] + sorted(boundaries) + [None]
+    partitions = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        q = query
+        if lo is not None:
+            q = q.filter(**{column + '__gte': lo})
+        if hi is not None:
+            q = q.filter(**{column + '__lt': hi})
+        partitions.append(QueryPartition(q.conditions))
+    return partitions
+
+
+def _scan_worker(address, func, tasks, results, batch_size, chunk_size):
+    t = Tyrant.open(*address)
+    try:
+        while True:
+            partition = tasks.get()
+            if partition is None:
+                break
+            chunk = []
+            for result in func(partition.records(t, batch_size)):
+                chunk.append(result)
+                if len(chunk) >= chunk_size:
+                    results.put(('results', chunk))
+                    chunk = []
+            if chunk:
+                results.put(('results', chunk))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+    else:
+        results.put(('done', None))
+    finally:
+        t.close()
+
+
+def parallel_scan(address, func, partitions, processes=None, batch_size=1000,
+                  chunk_size=100, queue_size=64):
+    """Run func over the records of every partition in worker processes and
+    yield its results.
+
+    address : Arguments of Tyrant.open() for the workers' connections
+    func : Called with an iterator of the (key, value) records of one
+           partition, returns an iterable of results
+    partitions : PrefixPartitions, RangePartitions or QueryPartitions
+    processes : Number of workers (default=None => number of CPUs, at most
+                one per partition)
+    batch_size : Records fetched per request
+    chunk_size : Results sent back to this process at a time
+    queue_size : Chunks waiting to be consumed before the workers block
+
+    Results arrive in no particular order. A failing worker raises a
+    RuntimeError with its traceback.
+    """
+    partitions = list(partitions)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(partitions)))
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue(queue_size)
+    for partition in partitions:
+        tasks.put(partition)
+    for i in xrange(processes):
+        tasks.put(None)
+    workers = [multiprocessing.Process(target=_scan_worker, args=(
+        address, func, tasks, results, batch_size, chunk_size))
+        for i in xrange(processes)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    running = processes
+    try:
+        while running:
+            try:
+                kind, payload = results.get(True, 1.0)
+            except Queue.Empty:
+                if not [w for w in workers if w.is_alive()]:
+                    raise RuntimeError('Scan workers exited unexpectedly')
+                continue
+            if kind == 'results':
+                for result in payload:
+                    yield result
+            elif kind == 'error':
+                raise RuntimeError('Scan worker failed:\n' + payload)
+            else:
+                running -= 1
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
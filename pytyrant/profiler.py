@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Query profiling and index recommendations for table databases
+
+A QueryProfiler attached to a PyTableTyrant records every search run by its
+queries, grouped by query pattern: the filtered columns with their
+operations and the sort orders, regardless of the values searched for.
+Searches slower than a threshold are kept in a slow query log::
+
+    >>> from pytyrant.pytyrant import PyTableTyrant
+    >>> from pytyrant.profiler import QueryProfiler
+    >>> t = PyTableTyrant.open('127.0.0.1', 1978)
+    >>> t.profiler = QueryProfiler(slow_threshold=0.05)
+    >>> t.search.filter(name='John', age__gt=30).order_by_num('age')[:10]
+    ...
+    >>> t.profiler.recommend()
+    [('age', 1, 0.61, 120), ('name', 0, 0.48, 120)]
+
+Columns compared with numeric operations (QUERY_OPERATIONS 'num' and
+'list_num') or sorted numerically get a decimal index recommended. A lexical
+index only helps the string operations is, startswith and list_str in (streq,
+strbw and stroreq) and lexical sorting; no index is recommended for columns
+only searched with contains, endswith, regex or the other list_str
+operations. With ``auto_index=True`` the recommended indexes are created
+through PyTableTyrant.setindex as soon as a slow search uses the column.
+
+The server can't be asked for its indexes, so the profiler only knows those
+passed as ``indexes`` or created through setindex while it is attached.
+unused_indexes() lists those of them no profiled search has used.
+
+"""
+import collections
+import threading
+import time
+
+from pytyrant import (QUERY_OPERATIONS, RDBITLEXICAL, RDBITDECIMAL,
+                      RDBITKEEP, RDBITOPT, RDBITVOID, RDBQONUMASC,
+                      RDBQONUMDESC)
+
+__all__ = ['QueryProfiler', 'PatternStats']
+
+NUMERIC_OPERATIONS = frozenset(QUERY_OPERATIONS['num'].values() +
+                               QUERY_OPERATIONS['list_num'].values())
+# streq, strbw and stroreq; the other string operations scan every record
+LEXICAL_OPERATIONS = frozenset(['0', '2', '6'])
+
+
+def parse_conditions(conditions):
+    """Return the pattern of a list of search conditions: a tuple of
+    ('cond', column, index type) and ('order', column, index type) entries.
+    The index type is None for conditions no index can speed up.
+
+    >>> parse_conditions(['addcond\\x00name\\x002\\x00Jo',
+    ...                   'addcond\\x00bio\\x001\\x00cat',
+    ...                   'setorder\\x00age\\x002'])
+    (('cond', 'name', 0), ('cond', 'bio', None), ('order', 'age', 1))
+    """
+    pattern = []
+    for condition in conditions:
+        parts = condition.split('\x00')
+        if parts[0] == 'addcond':
+            column, opcode = parts[1], parts[2]
+            if opcode in NUMERIC_OPERATIONS:
+                pattern.append(('cond', column, RDBITDECIMAL))
+            elif opcode in LEXICAL_OPERATIONS:
+                pattern.append(('cond', column, RDBITLEXICAL))
+            else:
+                pattern.append(('cond', column, None))
+        elif parts[0] == 'setorder':
+            column, direction = parts[1], int(parts[2])
+            if direction in (RDBQONUMASC, RDBQONUMDESC):
+                pattern.append(('order', column, RDBITDECIMAL))
+            else:
+                pattern.append(('order', column, RDBITLEXICAL))
+    return tuple(pattern)
+
+
+class PatternStats(object):
+    """Statistics of all searches with the same pattern
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_results = 0
+
+    def __repr__(self):
+        return '<PatternStats %r count=%d total_time=%.3f>' % (
+            self.pattern, self.count, self.total_time)
+
+    @property
+    def avg_time(self):
+        return self.count and self.total_time / self.count or 0.0
+
+    def add(self, elapsed, results):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.total_results += results
+
+
+class QueryProfiler(object):
+    """Collect search statistics and recommend column indexes
+
+    slow_threshold : searches taking longer (in seconds) are logged
+        (default=0.1)
+    slow_log_size : number of slow searches kept (default=100)
+    indexes : existing indexes as a {column: index type} dict
+    auto_index : create recommended indexes when a slow search needs them
+        (default=False)
+    """
+    def __init__(self, slow_threshold=0.1, slow_log_size=100, indexes=None,
+                 auto_index=False):
+        self.slow_threshold = slow_threshold
+        self.slow_log = collections.deque(maxlen=slow_log_size)
+        self.indexes = dict(indexes or {})
+        self.auto_index = auto_index
+        self.patterns = {}
+        self._lock = threading.Lock()
+
+    def record(self, ptt, conditions, elapsed, results):
+        """Called by Query for every search
+        """
+        pattern = parse_conditions(conditions)
+        with self._lock:
+            stats = self.patterns.get(pattern)
+            if stats is None:
+                stats = self.patterns[pattern] = PatternStats(pattern)
+            stats.add(elapsed, results)
+        if elapsed >= self.slow_threshold:
+            self.slow_log.append((time.time(), list(conditions), elapsed,
+                                  results))
+            if self.auto_index:
+                for kind, column, index_type in pattern:
+                    if self._needs_index(column, index_type):
+                        ptt.setindex(column, index_type)
+                        # setindex reports back through index_changed
+
+    def index_changed(self, column, index_type):
+        """Called by PyTableTyrant.setindex
+        """
+        index_type &= ~RDBITKEEP
+        if index_type == RDBITVOID:
+            self.indexes.pop(column, None)
+        elif index_type != RDBITOPT:
+            self.indexes[column] = index_type
+
+    def _needs_index(self, column, index_type):
+        # '' is the primary key, which needs no index
+        return (column != '' and index_type is not None and
+                self.indexes.get(column) != index_type)
+
+    def reset(self):
+        with self._lock:
+            self.patterns.clear()
+        self.slow_log.clear()
+
+    def slowest(self, n=10):
+        """The n patterns with the largest total time
+        """
+        patterns = sorted(self.patterns.values(),
+                          key=lambda s: s.total_time, reverse=True)
+        return patterns[:n]
+
+    def recommend(self):
+        """Recommended indexes as a list of (column, index type, total
+        seconds, searches) tuples, most expensive first. A column used both
+        ways gets the index type of its more expensive use.
+        """
+        usage = {}
+        for stats in self.patterns.values():
+            for column, index_type in set((c, t) for k, c, t in stats.pattern
+                                          if t is not None):
+                seconds, count = usage.get((column, index_type), (0.0, 0))
+                usage[column, index_type] = (seconds + stats.total_time,
+                                             count + stats.count)
+        best = {}
+        for (column, index_type), (seconds, count) in usage.iteritems():
+            if column not in best or seconds > best[column][2]:
+                best[column] = (column, index_type, seconds, count)
+        return sorted([r for r in best.values()
+                       if self._needs_index(r[0], r[1])],
+                      key=lambda r: r[2], reverse=True)
+
+    def unused_indexes(self):
+        """Known indexes on columns no profiled search used
+        """
+        used = set()
+        for pattern in self.patterns:
+            used.update(column for kind, column, index_type in pattern
+                        if index_type is not None)
+        return sorted(column for column in self.indexes if column not in used)
@@ -36,10 +36,18 @@ for the raw Tyrant protocol::
     the extended version of PyTyrant was automatically chosen.)
 
 """
+import array
+import collections
+import hashlib
 import itertools
 import math
+import Queue
+import re
 import socket
 import struct
+import sys
+import threading
+import time
 import UserDict
 
 __all__ = [
@@ -54,6 +62,9 @@ class TyrantError(Exception):
 DEFAULT_PORT = 1978
 MAGIC = 0xc8
 
+# Buffer size used when streaming values from and to files
+STREAM_CHUNK = 1 << 16
+
 RDBMONOULOG = 1 << 0
 RDBXOLCKREC = 1 << 0
 RDBXOLCKGLB = 1 << 1
@@ -63,8 +74,8 @@ RDBQOSTRASC, RDBQOSTRDESC, RDBQONUMASC, RDBQONUMDESC = range(4)
 # Enumeration for index types (from tcrdb.h, tctdb.h)
 RDBITLEXICAL = TDBITLEXICAL = 0    # Lexical string
 RDBITDECIMAL = TDBITDECIMAL = 1    # Decimal string
-RDBITOPT = TDBITOPT = 9998,        # Optimize
-RDBITVOID = TDBITVOID = 9999,      # Void
+RDBITOPT = TDBITOPT = 9998        # Optimize
+RDBITVOID = TDBITVOID = 9999       # Void
 RDBITKEEP = TDBITKEEP = 1 << 24    # Keep existing index
 
 
@@ -212,7 +223,10 @@ def socksend(sock, lst):
 def sockrecv(sock, bytes):
     d = ''
     while len(d) < bytes:
-        d += sock.recv(min(8192, bytes - len(d)))
+        chunk = sock.recv(min(8192, bytes - len(d)))
+        if not chunk:
+            raise socket.error('Connection closed by the server')
+        d += chunk
     return d
 
 
@@ -256,13 +270,57 @@ def list_to_dict(lst):
         lst = list(lst)
     return dict((lst[i], lst[i + 1]) for i in xrange(0, len(lst), 2))
 
+
+def dict_to_record(dct):
+    """Encode a dict as a table database record (NUL separated columns)"""
+    return '\x00'.join(dict_to_list(dct))
+
+class BloomFilter(object):
+    """Probabilistic set of keys without false negatives
+
+    capacity : expected number of keys
+    error_rate : false positive rate at capacity (default=0.01)
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+                                       math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing with both halves of an MD5 digest
+        digest = hashlib.md5(str(key)).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
 def get_tyrant_stats(tyrant):
     return dict(l.split('\t', 1) for l in tyrant.stat().splitlines() if l)
 
 def open_tyrant(*args, **kw):
     "Opens connection and returns an appropriate PyTyrant class."
     t = Tyrant.open(*args, **kw)
-    if get_tyrant_stats(t).get('type') == 'table':
+    dbtype = get_tyrant_stats(t).get('type')
+    if dbtype == 'table':
         return PyTableTyrant(t)
     else:
         return PyTyrant(t)
@@ -270,7 +328,16 @@ def open_tyrant(*args, **kw):
 class PyTyrant(object, UserDict.DictMixin):
     """
     Dict-like proxy for a Tyrant instance
+
+    bloom can be set to a BloomFilter of all keys (see attach_bloom) to
+    answer lookups of missing keys without asking the server.
+
+    hotkeys can be set to a pytyrant.hotkeys.HotKeyTracker to sample the
+    keys of reads, writes and removals.
     """
+    bloom = None
+    hotkeys = None
+
     @classmethod
     def open(cls, *args, **kw):
         return cls(Tyrant.open(*args, **kw))
@@ -278,6 +345,11 @@ class PyTyrant(object, UserDict.DictMixin):
     def __init__(self, t):
         self.t = t
 
+    def clone(self):
+        """Return a proxy using a new connection to the same server
+        """
+        return self.__class__(self.t.clone())
+
     def __repr__(self):
         # The __repr__ for UserDict.DictMixin isn't desirable
         # for a large KV store :)
@@ -287,6 +359,8 @@ class PyTyrant(object, UserDict.DictMixin):
         return key in self
 
     def __contains__(self, key):
+        if self._missing(key):
+            return False
         try:
             self.t.vsiz(key)
         except TyrantError:
@@ -294,7 +368,79 @@ class PyTyrant(object, UserDict.DictMixin):
         else:
             return True
 
+    def contains_many(self, keys, batch_size=1000, use_getlist=False):
+        """Return the set of the given keys which exist
+
+        Keys are checked batch_size at a time with pipelined vsiz requests,
+        or with getlist if use_getlist is set (which also transfers the
+        values, but is a single request per batch).
+        """
+        found = set()
+        batch = []
+        for key in keys:
+            if not self._missing(key):
+                batch.append(key)
+            if len(batch) >= batch_size:
+                found.update(self._contains_batch(batch, use_getlist))
+                batch = []
+        if batch:
+            found.update(self._contains_batch(batch, use_getlist))
+        return found
+
+    def _contains_batch(self, keys, use_getlist):
+        if use_getlist:
+            rval = self.t.misc('getlist', 0, [str(k) for k in keys])
+            present = set(rval[::2])
+            return [k for k in keys if str(k) in present]
+        sizes = self.t.vsiz_many([str(k) for k in keys])
+        return [k for k, size in zip(keys, sizes) if size is not None]
+
+    def attach_bloom(self, capacity=None, error_rate=0.01, batch_size=1000):
+        """Fill a BloomFilter with all keys of the database and use it to
+        answer lookups of missing keys locally.
+
+        Keys written through this instance are added to the filter, but
+        keys written by other clients are not: only use it if this is the
+        only writer, or attach a fresh filter regularly. capacity defaults
+        to twice the current number of records.
+        """
+        if capacity is None:
+            capacity = 2 * len(self)
+        bloom = BloomFilter(capacity, error_rate)
+        self.t.iterinit()
+        while True:
+            keys = self.t.iternext_many(batch_size)
+            if not keys:
+                break
+            bloom.update(keys)
+        self.bloom = bloom
+        return bloom
+
+    def detach_bloom(self):
+        self.bloom = None
+
+    def _missing(self, key):
+        return self.bloom is not None and key not in self.bloom
+
+    def _remember(self, key):
+        if self.bloom is not None:
+            self.bloom.add(key)
+
+    def _sample(self, op, key, size=0):
+        # Only called with hotkeys set
+        if self.hotkeys.sample():
+            self.hotkeys.record(op, key, size)
+
+    def _sample_many(self, op, keys, values=None):
+        for i, key in enumerate(keys):
+            if self.hotkeys.sample():
+                value = values and values[i]
+                self.hotkeys.record(op, key, value and len(value) or 0)
+
     def setdefault(self, key, value):
+        self._remember(key)
+        if self.hotkeys is not None:
+            self._sample('put', key, len(value))
         try:
             self.t.putkeep(key, value)
         except TyrantError:
@@ -302,15 +448,25 @@ class PyTyrant(object, UserDict.DictMixin):
         return value
 
     def __setitem__(self, key, value):
+        self._remember(key)
+        if self.hotkeys is not None:
+            self._sample('put', key, len(value))
         self.t.put(key, value)
 
     def __getitem__(self, key):
+        if self._missing(key):
+            raise KeyError(key)
         try:
-            return self.t.get(key)
+            value = self.t.get(key)
         except TyrantError:
             raise KeyError(key)
+        if self.hotkeys is not None:
+            self._sample('get', key, len(value))
+        return value
 
     def __delitem__(self, key):
+        if self.hotkeys is not None:
+            self._sample('out', key)
         try:
             self.t.out(key)
         except TyrantError:
@@ -363,6 +519,8 @@ class PyTyrant(object, UserDict.DictMixin):
         opts = (no_update_log and RDBMONOULOG or 0)
         if not isinstance(keys, (list, tuple)):
             keys = list(keys)
+        if self.hotkeys is not None:
+            self._sample_many('out', keys)
         self.t.misc("outlist", opts, keys)
 
     def multi_get(self, keys, no_update_log=False):
@@ -374,16 +532,23 @@ class PyTyrant(object, UserDict.DictMixin):
             # 1.1.10 protocol, may return invalid results
             if len(rval) < len(keys):
                 raise KeyError("Missing a result, unusable response in 1.1.10")
-            return rval
-        # 1.1.11 protocol returns interleaved key, value list
-        d = list_to_dict(rval)
-        return map(d.get, keys)
+            values = rval
+        else:
+            # 1.1.11 protocol returns interleaved key, value list
+            d = list_to_dict(rval)
+            values = map(d.get, keys)
+        if self.hotkeys is not None:
+            self._sample_many('get', keys, values)
+        return values
 
     def multi_set(self, items, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
         lst = []
         for k, v in items:
+            self._remember(k)
             lst.extend((k, v))
+        if self.hotkeys is not None:
+            self._sample_many('put', lst[::2], lst[1::2])
         self.t.misc("putlist", opts, lst)
 
     def call_func(self, func, key, value, record_locking=False, global_locking=False):
@@ -392,6 +557,22 @@ class PyTyrant(object, UserDict.DictMixin):
             (global_locking and RDBXOLCKGLB or 0))
         return self.t.ext(func, opts, key, value)
 
+    def get_into(self, key, writable):
+        """Stream the value of key into a file or buffer, see Tyrant.get_into
+        """
+        if self._missing(key):
+            raise KeyError(key)
+        try:
+            return self.t.get_into(key, writable)
+        except TyrantError:
+            raise KeyError(key)
+
+    def put_from(self, key, fileobj, length):
+        """Set key to length bytes streamed from fileobj
+        """
+        self._remember(key)
+        self.t.put_from(key, fileobj, length)
+
     def get_size(self, key):
         try:
             return self.t.vsiz(key)
@@ -401,12 +582,243 @@ class PyTyrant(object, UserDict.DictMixin):
     def get_stats(self):
         return get_tyrant_stats(self.t)
 
+    def range(self, start=None, stop=None, reverse=False, page_size=1000,
+              include_start=True, include_stop=False, prefetch=False):
+        """Iterate over the (key, value) pairs of a B+ tree database with
+        start <= key < stop in key order, fetching page_size records at a
+        time with the "range" misc function.
+
+        include_start and include_stop choose whether the bounds are
+        inclusive. With prefetch the next page is requested before the
+        current one is consumed; the connection must not be used for
+        anything else until the iteration is finished or closed.
+
+        reverse=True yields the records in descending order. The server can
+        only scan forward, so this first pages through the range keeping
+        one key per page, then fetches the pages again from the last one;
+        every record is transferred twice.
+        """
+        if start is None:
+            start = ''
+        elif not include_start:
+            # The next possible key after start
+            start += '\x00'
+        if stop is not None and include_stop:
+            stop += '\x00'
+        if not reverse:
+            return self._range(start, stop, page_size, prefetch)
+        return self._range_reverse(start, stop, page_size)
+
+    def _range(self, start, stop, page_size, prefetch=False):
+        def args(start):
+            if stop is None:
+                return [start, str(page_size)]
+            return [start, str(page_size), stop]
+        pending = False
+        if prefetch:
+            self.t._misc_send('range', 0, args(start))
+            pending = True
+        try:
+            while True:
+                if prefetch:
+                    pending = False
+                    page = self.t._misc_recv()
+                else:
+                    page = self.t.misc('range', 0, args(start))
+                last = len(page) < 2 * page_size
+                if not last:
+                    start = page[-2] + '\x00'
+                    if prefetch:
+                        self.t._misc_send('range', 0, args(start))
+                        pending = True
+                for i in xrange(0, len(page), 2):
+                    yield page[i], page[i + 1]
+                if last:
+                    return
+        finally:
+            if pending:
+                # Read the answer to the prefetched request to keep the
+                # connection usable
+                try:
+                    self.t._misc_recv()
+                except TyrantError:
+                    pass
+
+    def _range_reverse(self, start, stop, page_size):
+        bounds = []
+        for i, (k, v) in enumerate(self._range(start, stop, page_size)):
+            if not i % page_size:
+                bounds.append(k)
+        upper = stop
+        for lower in reversed(bounds):
+            page = list(self._range(lower, upper, page_size + 1))
+            for item in reversed(page):
+                yield item
+            upper = lower
+
     def prefix_keys(self, prefix, maxkeys=None):
         if maxkeys is None:
-            maxkeys = len(self)
+            # A negative maximum (as int32) means no limit
+            maxkeys = 0xffffffff
         return self.t.fwmkeys(prefix, maxkeys)
 
+    def _is_ordered(self):
+        if getattr(self, '_dbtype', None) is None:
+            self._dbtype = get_tyrant_stats(self.t).get('type')
+        return self._dbtype in ('B+ tree', 'on-memory tree')
+
+    def _prefix_pages(self, prefix, batch_size):
+        """Yield (keys, pairs) for batches of keys starting with prefix.
+        pairs is the interleaved key/value list if the scan returned the
+        values anyway, otherwise None.
+        """
+        if self._is_ordered():
+            # The keys with the prefix are one contiguous range
+            stop = prefix.rstrip('\xff')
+            if stop:
+                stop = stop[:-1] + chr(ord(stop[-1]) + 1)
+            else:
+                stop = None
+            start = prefix
+            while True:
+                args = [start, str(batch_size)]
+                if stop is not None:
+                    args.append(stop)
+                page = self.t.misc('range', 0, args)
+                if page:
+                    yield page[::2], page
+                if len(page) < 2 * batch_size:
+                    return
+                start = page[-2] + '\x00'
+        else:
+            self.t.iterinit()
+            while True:
+                keys = self.t.iternext_many(batch_size)
+                if not keys:
+                    return
+                keys = [k for k in keys if k.startswith(prefix)]
+                if keys:
+                    yield keys, None
+
+    def iter_prefix(self, prefix, batch_size=1000):
+        """Iterate over the keys starting with prefix without buffering more
+        than batch_size of them.
+
+        B+ tree and on-memory tree databases are read as a key range, all
+        other databases are scanned completely with pipelined iteration
+        requests.
+        """
+        for keys, pairs in self._prefix_pages(prefix, batch_size):
+            for key in keys:
+                yield key
+
+    def count_prefix(self, prefix, batch_size=1000, progress=None):
+        """Count the keys starting with prefix
+        """
+        count = 0
+        for keys, pairs in self._prefix_pages(prefix, batch_size):
+            count += len(keys)
+            if progress is not None:
+                progress(count)
+        return count
+
+    def delete_prefix(self, prefix, batch_size=1000, no_update_log=False,
+                      pipeline=False, progress=None):
+        """Remove all records whose key starts with prefix, batch_size at a
+        time. Returns the number of records removed.
+
+        With pipeline the removal runs over a second connection in a
+        background thread while the next batch is looked up. progress is
+        called with the number of records removed so far, from that thread
+        with pipeline.
+        """
+        opts = (no_update_log and RDBMONOULOG or 0)
+        return self._prefix_write(prefix, batch_size, progress, pipeline,
+                                  self.t, lambda t, keys, pairs:
+                                  t.misc('outlist', opts, keys))
+
+    def copy_prefix(self, dest, prefix, batch_size=1000, no_update_log=False,
+                    pipeline=False, progress=None):
+        """Copy all records whose key starts with prefix into dest (a
+        PyTyrant of the same database type), batch_size at a time. Returns
+        the number of records copied.
+
+        With pipeline dest is written from a background thread over a
+        second connection. progress is called with the number of records
+        copied so far, from that thread with pipeline.
+        """
+        opts = (no_update_log and RDBMONOULOG or 0)
+
+        def write(t, keys, pairs):
+            if pairs is None:
+                pairs = self.t.misc('getlist', 0, keys)
+            for key in pairs[::2]:
+                dest._remember(key)
+            t.misc('putlist', opts, pairs)
+        if pipeline:
+            # Values have to be fetched here, the source connection is busy
+            def pages():
+                for keys, pairs in self._prefix_pages(prefix, batch_size):
+                    if pairs is None:
+                        pairs = self.t.misc('getlist', 0, keys)
+                    yield keys, pairs
+        else:
+            pages = None
+        return self._prefix_write(prefix, batch_size, progress, pipeline,
+                                  dest.t, write, pages and pages())
+
+    def _prefix_write(self, prefix, batch_size, progress, pipeline, t, write,
+                      pages=None):
+        if pages is None:
+            pages = self._prefix_pages(prefix, batch_size)
+        count = 0
+        if not pipeline:
+            for keys, pairs in pages:
+                write(t, keys, pairs)
+                count += len(keys)
+                if progress is not None:
+                    progress(count)
+            return count
+
+        writer_t = t.clone()
+        todo = Queue.Queue(2)
+        errors = []
+        written = [0]
+
+        def writer():
+            # Progress is reported from here, once a batch is written
+            while True:
+                job = todo.get()
+                if job is None:
+                    return
+                if not errors:
+                    try:
+                        write(writer_t, *job)
+                        written[0] += len(job[0])
+                        if progress is not None:
+                            progress(written[0])
+                    except Exception, e:
+                        errors.append(e)
+        thread = threading.Thread(target=writer)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            for keys, pairs in pages:
+                if errors:
+                    break
+                todo.put((keys, pairs))
+        finally:
+            todo.put(None)
+            thread.join()
+            writer_t.close()
+        if errors:
+            raise errors[0]
+        return written[0]
+
     def concat(self, key, value, width=None):
+        self._remember(key)
+        if self.hotkeys is not None:
+            self._sample('put', key, len(value))
         if width is None:
             self.t.putcat(key, value)
         else:
@@ -419,10 +831,31 @@ class PyTyrant(object, UserDict.DictMixin):
         self.t.close()
 
 
+class Param(object):
+    """Placeholder for a value bound when a prepared query is executed
+
+    type is the type of the values, which determines the operation used:
+    str, int or float, or list for lists of item_type.
+    """
+    def __init__(self, name, type=str, item_type=str):
+        self.name = name
+        self.type = type
+        self.item_type = item_type
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
+
+    def sample(self):
+        if self.type is list:
+            return [self.item_type()]
+        return self.type()
+
+
 class Query(object):
     def __init__(self, ptt):
         self.ptt = ptt
         self.conditions = []
+        self.param_conditions = []
         self._result_cache = None
     
     def __iter__(self):
@@ -457,11 +890,11 @@ class Query(object):
             else:
                 limit = -1
             condition = '\x00'.join(('setlimit', str(limit), str(k.start or 0)))
-            resp = self.ptt.t.misc('search', 0, self.conditions + [condition])
+            resp = self._search(self.conditions + [condition])
             return k.step and list(resp)[::k.step] or resp
 
         condition = '\x00'.join(('setlimit', str(1), str(k)))
-        resp = self.ptt.t.misc('search', 0, self.conditions + [condition])
+        resp = self._search(self.conditions + [condition])
         if not resp:
             return None
         else:
@@ -501,29 +934,188 @@ class Query(object):
             else:
                 field, lookup = key, None
 
+            if isinstance(value, Param):
+                sample = value.sample()
+            else:
+                sample = value
             try:
-                opcode = self._determine_operation(lookup, value)
+                opcode = self._determine_operation(lookup, sample)
             except KeyError:
                 raise ValueError('"%s" is not a valid lookup for value %s'
                                  % (lookup, value))
 
-            # prepare value
-            if isinstance(value, (int,float)):
-                # coerce number to string
-                value = str(value)
-            if lookup == 'iregex':
-                # add asterisk for case-insensitive regular expression
-                value = '*%s' % value
-            if not isinstance(value, basestring) and hasattr(value, '__iter__'):
-                # Value is a list. Make it a comma separated string.
-                value = ','.join(str(x) for x in value)
-            condition = '\x00'.join(["addcond", field, opcode, value])
+            if isinstance(value, Param):
+                prefix = '\x00'.join(["addcond", field, opcode, ''])
+                q.param_conditions.append((prefix, lookup, value))
+                continue
+            condition = '\x00'.join(["addcond", field, opcode,
+                                     self._encode_value(lookup, value)])
             q.conditions.append(condition)
         return q
 
+    @staticmethod
+    def _encode_value(lookup, value):
+        if isinstance(value, (int,float)):
+            # coerce number to string
+            value = str(value)
+        if lookup == 'iregex':
+            # add asterisk for case-insensitive regular expression
+            value = '*%s' % value
+        if not isinstance(value, basestring) and hasattr(value, '__iter__'):
+            # Value is a list. Make it a comma separated string.
+            value = ','.join(str(x) for x in value)
+        return value
+
+    def prepare(self, cache_size=0, ttl=None):
+        """Compile the query into a PreparedQuery. Values given as Param
+        placeholders to filter() are bound when it is executed::
+
+            >>> by_name = t.search.filter(name=Param('name'),
+            ...                           age__gt=Param('age', int)).prepare()
+            >>> by_name(name='John', age=30)
+            ['john_doe']
+
+        With cache_size > 0 results are cached by their parameters, keeping
+        the cache_size most recently used results for at most ttl seconds
+        (default=None => until invalidate() is called).
+        """
+        return PreparedQuery(self, cache_size, ttl)
+
     def items(self):
         return self.ptt.multi_get(list(self))
+
+    def to_columns(self, *fields, **kw):
+        """Fetch the given columns of all matching records as arrays.
+
+        Returns (columns, present), two dicts by field. Each column is an
+        array.array of the field's type and each present a bytearray with 1
+        for every record having a valid value for the field; missing values
+        are 0. The field '' is the primary key.
+
+        types : {field: typecode} dict or one typecode for all fields
+                (default='d'); a typecode of None keeps the strings in a list
+        batch_size : records fetched per getlist (default=1000)
+        numpy : return numpy arrays and boolean masks instead (default=None
+                => if numpy is installed)
+
+        Records are decoded one batch at a time and only the requested
+        fields are kept, so memory use depends on the columns fetched.
+
+            >>> cols, present = t.search.filter(age__gt=30).to_columns(
+            ...     'age', 'score', types={'age': 'l'})
+            >>> cols['age']
+            array('l', [31, 45])
+        """
+        types = kw.pop('types', 'd')
+        batch_size = kw.pop('batch_size', 1000)
+        use_numpy = kw.pop('numpy', None)
+        if kw:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+        if use_numpy or use_numpy is None:
+            try:
+                import numpy
+            except ImportError:
+                if use_numpy:
+                    raise
+                use_numpy = False
+            else:
+                use_numpy = True
+        if not isinstance(types, dict):
+            types = dict.fromkeys(fields, types)
+        columns, present, convert = {}, {}, {}
+        for field in fields:
+            typecode = types.get(field, 'd')
+            if typecode is None:
+                columns[field] = []
+                convert[field] = str
+            else:
+                columns[field] = array.array(typecode)
+                convert[field] = typecode in 'fd' and float or _to_int
+            present[field] = bytearray()
+        wanted = frozenset(fields)
+
+        keys = self._search(self.conditions)
+        for first in xrange(0, len(keys), batch_size):
+            rval = self.ptt.t.misc('getlist', 0, keys[first:first + batch_size])
+            for i in xrange(0, len(rval), 2):
+                # Records removed since the search are left out
+                row = {'': rval[i]}
+                parts = rval[i + 1].split('\x00')
+                for j in xrange(0, len(parts) - 1, 2):
+                    if parts[j] in wanted:
+                        row[parts[j]] = parts[j + 1]
+                for field in fields:
+                    value = row.get(field)
+                    if value is not None:
+                        try:
+                            # Values out of the typecode's range count as
+                            # missing too
+                            columns[field].append(convert[field](value))
+                        except (ValueError, OverflowError):
+                            value = None
+                        else:
+                            present[field].append(1)
+                    if value is None:
+                        columns[field].append(convert[field] is str and ''
+                                              or 0)
+                        present[field].append(0)
+
+        if use_numpy:
+            for field in fields:
+                if isinstance(columns[field], array.array):
+                    columns[field] = numpy.frombuffer(
+                        columns[field], dtype=columns[field].typecode).copy()
+                else:
+                    columns[field] = numpy.array(columns[field], dtype=object)
+                present[field] = numpy.frombuffer(
+                    present[field], dtype=numpy.bool_).copy()
+        return columns, present
     
+    def aggregate(self, group_by=None, sum=(), min=(), max=(), count=True,
+                  processes=None, page_size=10000, batch_size=1000):
+        """Aggregate the matching records without keeping them in memory.
+
+        group_by : field or tuple of fields to group by (default=None => one
+                   group)
+        sum, min, max : fields to aggregate as numbers; values that are
+                        missing or not numbers are skipped
+        count : count the records of every group
+        processes : number of worker processes (default=None => aggregate
+                    in this process)
+
+        Returns a dict of results like {'count': 2, 'price__sum': 12.5}, or
+        a {group: results} dict with group_by. The result is read in pages
+        of page_size records sorted by primary key, fetched with one getlist
+        per batch_size records. With processes every worker has its own
+        connection and every processes-th page, and their partial results
+        are merged.
+
+            >>> t.search.filter(age__gt=30).aggregate(group_by='city',
+            ...                                       sum=['score'])
+            {'Paris': {'count': 2, 'score__sum': 91.0}}
+        """
+        import parallel
+        agg = parallel.Aggregate(group_by, sum, min, max, count)
+        conditions = self._page_conditions()
+        if not processes:
+            parallel.aggregate_pages(self.ptt.t, conditions, agg, 0, 1,
+                                     page_size, batch_size)
+        else:
+            agg = parallel.aggregate_parallel(self.ptt.t.address(),
+                                              conditions, agg, processes,
+                                              page_size, batch_size)
+        return agg.result()
+
+    def _page_conditions(self):
+        # Pages cut with setlimit need a stable order
+        if self.param_conditions:
+            raise ValueError('Query has unbound parameters, use prepare()')
+        conditions = self.conditions
+        if not [c for c in conditions if c.startswith('setorder\x00')]:
+            conditions = conditions + ['\x00'.join(
+                ('setorder', '', str(RDBQOSTRASC)))]
+        return conditions
+
     def order_by_num(self, field):
         q = self._clone()
         if field.startswith('-'):
@@ -551,35 +1143,205 @@ class Query(object):
             klass = self.__class__
         q = klass(self.ptt)
         q.conditions = self.conditions[:]
+        q.param_conditions = self.param_conditions[:]
         q.__dict__.update(kwargs)
         return q
     
+    def _search(self, conditions):
+        if self.param_conditions:
+            raise ValueError('Query has unbound parameters, use prepare()')
+        profiler = self.ptt.profiler
+        if profiler is None:
+            return self.ptt.t.misc('search', 0, conditions)
+        start = time.time()
+        resp = self.ptt.t.misc('search', 0, conditions)
+        profiler.record(self.ptt, conditions, time.time() - start, len(resp))
+        return resp
+
     def _get_results(self):
         if self._result_cache is None:
-            self._result_cache = self.ptt.t.misc('search', 0, self.conditions)
+            self._result_cache = self._search(self.conditions)
         return self._result_cache
 
 
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+class PreparedQuery(object):
+    """A query compiled for repeated execution with different parameters.
+    See Query.prepare().
+    """
+    def __init__(self, query, cache_size=0, ttl=None):
+        self.query = query
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.names = frozenset(p.name for c, l, p in query.param_conditions)
+        self._templates = [(prefix, lookup, param.name)
+                           for prefix, lookup, param in query.param_conditions]
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def bind(self, **params):
+        """Return a Query with the parameters filled in
+        """
+        if set(params) != self.names:
+            raise TypeError('Expected parameters %s, got %s' %
+                            (', '.join(sorted(self.names)),
+                             ', '.join(sorted(params))))
+        q = Query(self.query.ptt)
+        q.conditions = self.query.conditions + [
+            prefix + Query._encode_value(lookup, params[name])
+            for prefix, lookup, name in self._templates]
+        return q
+
+    def __call__(self, **params):
+        """Return the list of matching keys
+        """
+        if not self.cache_size:
+            return list(self.bind(**params))
+        key = tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                           for k, v in params.iteritems()))
+        now = time.time()
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                self._cache[key] = entry
+                self.hits += 1
+                return list(entry[1])
+        self.misses += 1
+        result = list(self.bind(**params))
+        expires = self.ttl is not None and now + self.ttl or None
+        with self._lock:
+            self._cache[key] = (expires, result)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(False)
+        return list(result)
+
+    def invalidate(self):
+        """Drop all cached results
+        """
+        with self._lock:
+            self._cache.clear()
+
+
+class IdAllocator(object):
+    """Hand out unique integer IDs reserved in blocks from a counter record
+
+    Each reservation is one addint(counter, block_size) round trip; the IDs
+    of the block are then given out locally. The block size adapts to the
+    rate IDs are used at, aiming at one reservation every target_interval
+    seconds. IDs of a block not used up before the allocator is dropped are
+    lost, so IDs are unique and increasing but not gapless.
+
+    t : Tyrant connection holding the counter (used under the allocator's
+        lock only). On a table database addint stores the counter as a
+        record with a '_num' column, visible to searches and iteration; a
+        separate hash database keeps it out of the data.
+    counter : Key of the counter record (default='__id__')
+    block_size : Initial block size (default=100)
+    min_block, max_block : Limits of the adapted block size
+    target_interval : Seconds one block should last (default=1.0)
+    """
+    def __init__(self, t, counter='__id__', block_size=100, min_block=1,
+                 max_block=100000, target_interval=1.0):
+        self.t = t
+        self.counter = counter
+        self.block_size = block_size
+        self.min_block = min_block
+        self.max_block = max_block
+        self.target_interval = target_interval
+        self.reservations = 0
+        self._next = self._end = 0
+        self._reserved_at = None
+        self._lock = threading.Lock()
+
+    def _reserve(self, needed):
+        now = time.time()
+        if self._reserved_at is not None:
+            elapsed = now - self._reserved_at
+            if elapsed < self.target_interval / 2:
+                self.block_size = min(self.max_block, self.block_size * 2)
+            elif elapsed > self.target_interval * 2:
+                self.block_size = max(self.min_block, self.block_size // 2)
+        self._reserved_at = now
+        count = max(needed, self.block_size)
+        end = self.t.addint(self.counter, count)
+        self.reservations += 1
+        # The block is end - count + 1 .. end, unused IDs left over from the
+        # previous block are given up
+        self._next, self._end = end - count + 1, end + 1
+
+    def next(self):
+        """Return the next unique ID
+        """
+        return self.take(1)[0]
+
+    def take(self, count):
+        """Return a list of count unique IDs
+        """
+        with self._lock:
+            available = self._end - self._next
+            if available >= count:
+                ids = range(self._next, self._next + count)
+                self._next += count
+                return ids
+            ids = range(self._next, self._end)
+            self._reserve(count - available)
+            rest = count - available
+            ids.extend(xrange(self._next, self._next + rest))
+            self._next += rest
+            return ids
+
+
 class PyTableTyrant(PyTyrant):
     """
     Dict-like proxy for a Table-based Tyrant instance
+
+    Set profiler to a pytyrant.profiler.QueryProfiler to collect statistics
+    about the searches run through this instance.
+
+    ids is the IdAllocator of insert() and insert_many(). The default one
+    keeps its counter in the record '__id__' of this table, which shows up
+    in searches, iteration and len() like any other record. Assign an
+    IdAllocator whose counter lives in a separate hash database to keep the
+    table free of it.
     """
+    profiler = None
+
     def setdefault(self, key, value, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
+        self._remember(key)
+        lst = dict_to_list(value)
+        if self.hotkeys is not None:
+            self._sample('put', key, sum(map(len, lst)))
         try:
-            self.t.misc('putkeep', opts, [key] + dict_to_list(value))
+            self.t.misc('putkeep', opts, [key] + lst)
         except TyrantError:
             return self[key]
         return value
 
     def __setitem__(self, key, value):
-        self.t.misc('put', 0, [key] + dict_to_list(value))
+        self._remember(key)
+        lst = dict_to_list(value)
+        if self.hotkeys is not None:
+            self._sample('put', key, sum(map(len, lst)))
+        self.t.misc('put', 0, [key] + lst)
 
     def __getitem__(self, key):
+        if self._missing(key):
+            raise KeyError(key)
         try:
-            return list_to_dict(self.t.misc('get', 0, (key,)))
+            lst = self.t.misc('get', 0, (key,))
         except TyrantError:
             raise KeyError(key)
+        if self.hotkeys is not None:
+            self._sample('get', key, sum(map(len, lst)))
+        return list_to_dict(lst)
 
     def multi_get(self, keys, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
@@ -593,35 +1355,401 @@ class PyTableTyrant(PyTyrant):
             return list_to_dict(rval.split('\x00'))
         # 1.1.11 protocol returns interleaved key, value list
         d = dict((rval[i], rval[i + 1]) for i in xrange(0, len(rval), 2))
+        if self.hotkeys is not None:
+            self._sample_many('get', keys, map(d.get, keys))
         return [list_to_dict(d.get(i).split('\x00')) for i in keys]
 
     def multi_set(self, items, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
         lst = []
         for k, v in items:
-            lst.extend((k, '\x00'.join(dict_to_list(v))))
+            self._remember(k)
+            lst.extend((k, dict_to_record(v)))
+        if self.hotkeys is not None:
+            self._sample_many('put', lst[::2], lst[1::2])
         self.t.misc("putlist", opts, lst)
 
     def concat(self, key, value, width=None, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
+        self._remember(key)
         if width is None:
-            self.t.misc('putcat', opts, ([key] + dict_to_list(value)))
+            lst = dict_to_list(value)
+            if self.hotkeys is not None:
+                self._sample('put', key, sum(map(len, lst)))
+            self.t.misc('putcat', opts, [key] + lst)
         else:
             raise ValueError('Cannot concat with a width on a table database')
     
+    def update_columns(self, key, no_update_log=False, func=None, **cols):
+        """Set the given columns of the record key, keeping all others (a
+        missing record is created). See update_many.
+
+        Without func the whole record is read and written back, and a
+        write by another client to the record in between is lost.
+        """
+        self.update_many([(key, cols)], no_update_log=no_update_log,
+                         func=func)
+
+    def update_many(self, items, batch_size=1000, no_update_log=False,
+                    func=None):
+        """Set columns of many records, given as (key, {column: value})
+        pairs, keeping their other columns. Returns the number of records
+        updated.
+
+        Every batch_size records are read with one getlist, merged here and
+        written back with one putlist, so whole records go over the wire
+        both ways. Table putcat can't be used for this as it only adds
+        columns a record doesn't have yet. The merge is not atomic: a write
+        by another client to one of the records between the getlist and the
+        putlist is lost.
+
+        func names a Lua extension function of the server (see call_func)
+        doing the merge instead. It is called once per record under a
+        record lock with the key and only the changed columns, so nothing
+        is lost, e.g.::
+
+            function mergecols(key, value)
+              local cols = _split(value)
+              local fields = _split(_get(key) or "")
+              local rec, names = {}, {}
+              for i = 1, #fields - 1, 2 do
+                rec[fields[i]] = fields[i + 1]
+                table.insert(names, fields[i])
+              end
+              for i = 1, #cols - 1, 2 do
+                if rec[cols[i]] == nil then table.insert(names, cols[i]) end
+                rec[cols[i]] = cols[i + 1]
+              end
+              local parts = {}
+              for _, name in ipairs(names) do
+                table.insert(parts, name)
+                table.insert(parts, rec[name])
+              end
+              _put(key, table.concat(parts, "\\0"))
+              return "ok"
+            end
+
+        Extension calls go past the update log flag, so no_update_log
+        can't be combined with func.
+        """
+        if func is not None:
+            if no_update_log:
+                raise ValueError('no_update_log is not supported with func')
+            count = 0
+            for key, cols in items:
+                self._remember(key)
+                self.t.ext(func, RDBXOLCKREC, key, dict_to_record(cols))
+                count += 1
+            return count
+        opts = (no_update_log and RDBMONOULOG or 0)
+        count = 0
+        batch = []
+        for key, cols in items:
+            batch.append((key, cols))
+            if len(batch) >= batch_size:
+                count += self._update_batch(batch, opts)
+                batch = []
+        if batch:
+            count += self._update_batch(batch, opts)
+        return count
+
+    def _update_batch(self, batch, opts):
+        keys = [key for key, cols in batch]
+        rval = self.t.misc('getlist', 0, keys)
+        records = dict((rval[i], list_to_dict(rval[i + 1].split('\x00')))
+                       for i in xrange(0, len(rval), 2))
+        for key, cols in batch:
+            # A key given twice gets both updates
+            records.setdefault(key, {}).update(cols)
+        lst = []
+        for key in records:
+            self._remember(key)
+            lst.extend((key, dict_to_record(records[key])))
+        self.t.misc('putlist', opts, lst)
+        return len(batch)
+
+    def update_column(self, column, values, batch_size=1000,
+                      no_update_log=False, func=None):
+        """Set one column of many records; values is a dict or an iterable
+        of (key, value) pairs. Returns the number of records updated. See
+        update_many about concurrent writes and func.
+        """
+        if isinstance(values, dict):
+            values = values.iteritems()
+        return self.update_many(((k, {column: v}) for k, v in values),
+                                batch_size, no_update_log, func)
+
     def _search(self):
         return Query(self)
     search = property(_search)
 
+    def _get_ids(self):
+        # Created on first use over a connection of its own, closed by
+        # close(); assign an IdAllocator to configure it
+        if self.__dict__.get('_ids') is None:
+            self._ids_t = self.t.clone()
+            self._ids = IdAllocator(self._ids_t)
+        return self._ids
+
+    def _set_ids(self, allocator):
+        self._close_ids()
+        self._ids = allocator
+
+    def _close_ids(self):
+        ids_t = self.__dict__.pop('_ids_t', None)
+        if ids_t is not None:
+            ids_t.close()
+
+    ids = property(_get_ids, _set_ids)
+
+    def close(self):
+        self._close_ids()
+        self.t.close()
+
+    def insert(self, record, no_update_log=False):
+        """Store record under a new unique key from self.ids; returns the key
+        """
+        key = str(self.ids.next())
+        opts = (no_update_log and RDBMONOULOG or 0)
+        self._remember(key)
+        self.t.misc('put', opts, [key] + dict_to_list(record))
+        return key
+
+    def insert_many(self, records, batch_size=1000, no_update_log=False):
+        """Store records under new unique keys with one putlist per
+        batch_size records; returns the list of keys.
+        """
+        keys = []
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                keys.extend(self._insert_batch(batch, no_update_log))
+                batch = []
+        if batch:
+            keys.extend(self._insert_batch(batch, no_update_log))
+        return keys
+
+    def _insert_batch(self, records, no_update_log):
+        keys = [str(i) for i in self.ids.take(len(records))]
+        self.multi_set(zip(keys, records), no_update_log)
+        return keys
+
     def setindex(self, column, index_type=RDBITLEXICAL, no_update_log=False):
         """Create or modify secondary column index."""
         opts = (no_update_log and RDBMONOULOG or 0)
         self.t.misc("setindex", opts, (column, str(index_type)))
+        if self.profiler is not None:
+            self.profiler.index_changed(column, index_type)
+
+
+# struct format of a fixed-length record made of one repeated number type
+_HOMOGENEOUS_FORMAT = re.compile(r'^([@=<>!]?)(\d*)([bBhHiIlLqQfd])$')
+
+
+def _array_typecode(fmt):
+    """Return (typecode, byteswap) of an array.array holding records of
+    struct format fmt, or (None, False) if there is none.
+    """
+    match = _HOMOGENEOUS_FORMAT.match(fmt)
+    if match is None:
+        return None, False
+    order, count, code = match.groups()
+    size = struct.calcsize((order or '@') + code)
+    if code in 'fd':
+        candidates = 'fd'
+    elif code.isupper():
+        candidates = 'BHIL'
+    else:
+        candidates = 'bhil'
+    for typecode in candidates:
+        if array.array(typecode).itemsize == size:
+            break
+    else:
+        return None, False
+    if order in ('', '@', '='):
+        return typecode, False
+    return typecode, (order == '<') != (sys.byteorder == 'little')
+
+
+class PyFixedTyrant(PyTyrant):
+    """
+    Dict-like proxy for a fixed-length database with integer keys
+
+    Values are packed with the struct format fmt, e.g. '<8f' for vectors of
+    eight floats. The database width (see ttserver.TTFixedDB) must be at
+    least struct.calcsize(fmt). open_tyrant() returns a plain PyTyrant with
+    string values for fixed-length databases, use PyFixedTyrant.open() with
+    the format of the stored values instead.
+    """
+    @classmethod
+    def open(cls, *args, **kw):
+        fmt = kw.pop('fmt', '<d')
+        return cls(Tyrant.open(*args, **kw), fmt)
+
+    def __init__(self, t, fmt='<d'):
+        PyTyrant.__init__(self, t)
+        self.record = struct.Struct(fmt)
+        self.typecode, self.byteswap = _array_typecode(fmt)
+
+    def clone(self):
+        return self.__class__(self.t.clone(), self.record.format)
+
+    def _pack(self, value):
+        if not isinstance(value, (tuple, list)):
+            value = (value,)
+        return self.record.pack(*value)
+
+    def _unpack(self, data):
+        values = self.record.unpack(self._fit(data))
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    def _fit(self, data):
+        # Values shorter than the record were stored with another format
+        size = self.record.size
+        if len(data) != size:
+            return data[:size].ljust(size, '\x00')
+        return data
+
+    def __contains__(self, key):
+        return PyTyrant.__contains__(self, str(key))
+
+    def setdefault(self, key, value):
+        self._remember(key)
+        try:
+            self.t.putkeep(str(key), self._pack(value))
+        except TyrantError:
+            return self[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self._remember(key)
+        if self.hotkeys is not None:
+            self._sample('put', str(key), self.record.size)
+        self.t.put(str(key), self._pack(value))
+
+    def __getitem__(self, key):
+        if self._missing(key):
+            raise KeyError(key)
+        try:
+            value = self.t.get(str(key))
+        except TyrantError:
+            raise KeyError(key)
+        if self.hotkeys is not None:
+            self._sample('get', str(key), len(value))
+        return self._unpack(value)
+
+    def __delitem__(self, key):
+        if self.hotkeys is not None:
+            self._sample('out', str(key))
+        try:
+            self.t.out(str(key))
+        except TyrantError:
+            raise KeyError(key)
+
+    def iterkeys(self):
+        for key in PyTyrant.iterkeys(self):
+            yield int(key)
+
+    def multi_del(self, keys, no_update_log=False):
+        PyTyrant.multi_del(self, [str(k) for k in keys], no_update_log)
+
+    def multi_get(self, keys, no_update_log=False):
+        values = PyTyrant.multi_get(self, [str(k) for k in keys],
+                                    no_update_log)
+        return [None if v is None else self._unpack(v) for v in values]
+
+    def multi_set(self, items, no_update_log=False):
+        PyTyrant.multi_set(self, ((str(k), self._pack(v)) for k, v in items),
+                           no_update_log)
+
+    def get_size(self, key):
+        return PyTyrant.get_size(self, str(key))
+
+    def get_range(self, lo, hi, batch_size=1000):
+        """Fetch the records with ids lo <= id < hi.
+
+        Returns (values, present). values is an array.array of all record
+        fields one after the other if fmt is made of one number type, and a
+        bytearray of the packed records otherwise. present is a bytearray
+        with 1 for every id which exists; the record of a missing id is all
+        zeros.
+        """
+        size = self.record.size
+        count = max(0, hi - lo)
+        buf = bytearray(count * size)
+        present = bytearray(count)
+        for first in xrange(lo, hi, batch_size):
+            keys = [str(i) for i in xrange(first, min(hi, first + batch_size))]
+            rval = self.t.misc('getlist', 0, keys)
+            for i in xrange(0, len(rval), 2):
+                n = int(rval[i]) - lo
+                buf[n * size:(n + 1) * size] = self._fit(rval[i + 1])
+                present[n] = 1
+        if self.typecode is None:
+            return buf, present
+        values = array.array(self.typecode, str(buf))
+        if self.byteswap:
+            values.byteswap()
+        return values, present
+
+    def set_range(self, lo, values, batch_size=1000, no_update_log=False):
+        """Store consecutive records starting at id lo.
+
+        values is either a sequence of records (as accepted by
+        __setitem__), or an array.array, bytearray or string of packed
+        records as returned by get_range().
+        """
+        opts = (no_update_log and RDBMONOULOG or 0)
+        size = self.record.size
+        if isinstance(values, array.array):
+            if self.byteswap:
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            values = values.tostring()
+        if isinstance(values, (str, bytearray, buffer)):
+            if len(values) % size:
+                raise ValueError('Buffer size is not a multiple of %d' % size)
+            records = (str(values[i:i + size])
+                       for i in xrange(0, len(values), size))
+        else:
+            records = (self._pack(v) for v in values)
+        lst = []
+        for n, record in enumerate(records):
+            key = str(lo + n)
+            self._remember(key)
+            lst.extend((key, record))
+            if len(lst) >= 2 * batch_size:
+                self.t.misc('putlist', opts, lst)
+                lst = []
+        if lst:
+            self.t.misc('putlist', opts, lst)
+
+
+def unix_socket_path(host):
+    """Return the socket path if host names a UNIX domain socket (an
+    absolute path or a unix:// URL), otherwise None.
+    """
+    if host.startswith('unix://'):
+        return host[len('unix://'):]
+    if host.startswith('/'):
+        return host
+    return None
 
 
 class Tyrant(object):
     @classmethod
     def open(cls, host='127.0.0.1', port=DEFAULT_PORT):
+        """Connect to host:port, or to the UNIX domain socket host if it is
+        an absolute path or a unix:// URL (port is ignored then).
+        """
+        path = unix_socket_path(host)
+        if path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            return cls(sock)
         sock = socket.socket()
         sock.connect((host, port))
         sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
@@ -630,6 +1758,29 @@ class Tyrant(object):
     def __init__(self, sock):
         self.sock = sock
 
+    def address(self):
+        """Arguments of open() connecting to the same server
+        """
+        if self.sock.family == getattr(socket, 'AF_UNIX', None):
+            return ('unix://' + self.sock.getpeername(),)
+        return self.sock.getpeername()[:2]
+
+    def clone(self):
+        """Open a new connection to the same server
+        """
+        return self.__class__.open(*self.address())
+
+    def record(self, recorder):
+        """Log every request sent through this connection to recorder, a
+        pytyrant.replay.Recorder; None stops recording. Clones are not
+        recorded.
+        """
+        sock = getattr(self.sock, 'recorded_sock', self.sock)
+        if recorder is None:
+            self.sock = sock
+        else:
+            self.sock = recorder.wrap(sock)
+
     def close(self):
         self.sock.close()
 
@@ -679,6 +1830,91 @@ class Tyrant(object):
         socksuccess(self.sock)
         return sockstr(self.sock)
 
+    def get_into(self, key, writable):
+        """Stream the value of key into writable and return its size
+
+        writable is either a preallocated writable byte buffer supporting
+        memoryview (e.g. a bytearray) which the value is received into
+        directly, or an object with a write method such as a file. Only
+        STREAM_CHUNK bytes are buffered when writing to a file; if a write
+        fails the connection is closed, as the rest of the value is still
+        unread. Raises TypeError for a read-only buffer or one whose items
+        are not bytes, ValueError for a buffer shorter than the value.
+        """
+        try:
+            view = memoryview(writable)
+        except TypeError:
+            view = None
+        socksend(self.sock, _t1(C.get, key))
+        socksuccess(self.sock)
+        length = socklen(self.sock)
+        if view is None:
+            chunk = bytearray(min(length, STREAM_CHUNK))
+            view = memoryview(chunk)
+            remaining = length
+            try:
+                while remaining:
+                    n = self.sock.recv_into(view, min(remaining, len(chunk)))
+                    if not n:
+                        raise socket.error('Connection closed by the server')
+                    writable.write(buffer(chunk, 0, n))
+                    remaining -= n
+            except:
+                # The rest of the value is still unread
+                self.close()
+                raise
+            return length
+        if view.readonly:
+            error = TypeError('Buffer is not writable')
+        elif view.itemsize != 1:
+            error = TypeError('Buffer items are not bytes')
+        elif len(view) < length:
+            error = ValueError('Buffer too small for a value of %d bytes'
+                               % length)
+        else:
+            error = None
+        if error is not None:
+            # Keep the connection in sync before complaining
+            remaining = length
+            while remaining:
+                remaining -= len(sockrecv(self.sock,
+                                          min(remaining, STREAM_CHUNK)))
+            raise error
+        received = 0
+        while received < length:
+            n = self.sock.recv_into(view[received:], length - received)
+            if not n:
+                raise socket.error('Connection closed by the server')
+            received += n
+        return length
+
+    def put_from(self, key, fileobj, length):
+        """Set key to the next length bytes read from fileobj
+
+        The request header is sent first and the value is then streamed
+        from the file, STREAM_CHUNK bytes at a time.
+        """
+        socksend(self.sock, [
+            struct.pack('>BBII', MAGIC, C.put, len(key), length),
+            key,
+        ])
+        remaining = length
+        try:
+            while remaining:
+                data = fileobj.read(min(remaining, STREAM_CHUNK))
+                if not data:
+                    break
+                self.sock.sendall(data)
+                remaining -= len(data)
+        except:
+            # The server still waits for the rest of the value
+            self.close()
+            raise
+        if remaining:
+            self.close()
+            raise ValueError('File ended %d bytes before the value' % remaining)
+        socksuccess(self.sock)
+
     def _mget(self, klst):
         socksend(self.sock, _tN(C.mget, klst))
         socksuccess(self.sock)
@@ -712,6 +1948,33 @@ class Tyrant(object):
         socksuccess(self.sock)
         return sockstr(self.sock)
 
+    def vsiz_many(self, keys):
+        """Get the value sizes of several keys in one round trip
+
+        The requests are pipelined; missing keys get None.
+        """
+        socksend(self.sock, [''.join(_t1(C.vsiz, k)) for k in keys])
+        sizes = []
+        for k in keys:
+            if ord(sockrecv(self.sock, 1)):
+                sizes.append(None)
+            else:
+                sizes.append(socklen(self.sock))
+        return sizes
+
+    def iternext_many(self, count):
+        """Get up to count next keys after iterinit in one round trip
+
+        The requests are pipelined; an empty list means the iteration is over.
+        """
+        socksend(self.sock, _t0(C.iternext) * count)
+        keys = []
+        for i in xrange(count):
+            # Every request gets an answer, read them all to stay in sync
+            if not ord(sockrecv(self.sock, 1)):
+                keys.append(sockstr(self.sock))
+        return keys
+
     def _fwmkeys(self, prefix, maxkeys):
         socksend(self.sock, _t1M(C.fwmkeys, prefix, maxkeys))
         socksuccess(self.sock)
@@ -767,7 +2030,7 @@ class Tyrant(object):
     def restore(self, path, msec):
         """Restore the database from path at timestamp (in msec)
         """
-        socksend(self.sock, _t1R(C.copy, path, msec))
+        socksend(self.sock, _t1R(C.restore, path, msec))
         socksuccess(self.sock)
 
     def setmst(self, host, port):
@@ -797,15 +2060,20 @@ class Tyrant(object):
         socksuccess(self.sock)
         return sockstr(self.sock)
 
-    def _misc(self, func, opts, args):
+    def _misc_send(self, func, opts, args):
         # tcrdbmisc opts are RDBMONOULOG
         socksend(self.sock, _t1FN(C.misc, func, opts, args))
+
+    def _misc_recv(self):
         try:
             socksuccess(self.sock)
         finally:
             numrecs = socklen(self.sock)
-        for i in xrange(numrecs):
-            yield sockstr(self.sock)
+        return [sockstr(self.sock) for i in xrange(numrecs)]
+
+    def _misc(self, func, opts, args):
+        self._misc_send(func, opts, args)
+        return self._misc_recv()
 
     def misc(self, func, opts, args):
         """All databases support "putlist", "outlist", and "getlist".
@@ -815,6 +2083,10 @@ class Tyrant(object):
 
         Table database supports "setindex", "search", "genuid".
 
+        B+ tree and fixed-length databases support "range". It receives the
+        start key, the maximum number of records and the (exclusive) stop
+        key, and returns keys and values one after the other.
+
         opts is a bitflag that can be RDBMONOULOG to prevent writing to the update log
         """
         return list(self._misc(func, opts, args))
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""Record the requests of Tyrant connections and replay them
+
+A Recorder logs every request frame sent through the connections attached
+to it, with the time and a connection number, to a compact capture file::
+
+    magic      'PTREC\\x01'
+    record     >d time, >I connection, >I length, request bytes
+    ...
+
+    >>> from pytyrant.pytyrant import PyTyrant
+    >>> from pytyrant.replay import Recorder
+    >>> recorder = Recorder(open('/tmp/traffic.ptrec', 'wb'))
+    >>> t = PyTyrant.open('127.0.0.1', 1978)
+    >>> t.t.record(recorder)
+    >>> t['key'] = 'value'
+    ...
+    >>> recorder.close()
+
+replay() sends the captured requests to another server from one connection
+per captured connection (or a given number of connections), at the
+original pace, a multiple of it or as fast as possible. Pipelined requests
+are sent together again. The responses are read according to the request
+type, which gives the latency of every request::
+
+    $ pytyrant-replay --port 1979 --speed 2 /tmp/traffic.ptrec
+    $ pytyrant-replay --server '*' --port 1979 --max-speed /tmp/traffic.ptrec
+
+With --server a local ttserver with the given database is started for the
+replay and stopped afterwards. Replaying writes to the target server.
+
+"""
+import optparse
+import Queue
+import struct
+import sys
+import threading
+import time
+
+from pytyrant import (Tyrant, C, MAGIC, DEFAULT_PORT, sockrecv, socklen,
+                      sockstr)
+import ttserver
+
+__all__ = ['Recorder', 'ReplayError', 'iter_capture', 'parse_requests',
+           'replay', 'main']
+
+CAPTURE_MAGIC = 'PTREC\x01'
+RECORD = struct.Struct('>dII')
+
+COMMANDS = dict((v, k) for k, v in C.__dict__.items()
+                if isinstance(v, int))
+
+# Request header after magic and command code, and the length of the rest
+# of the request computed from it. mget and misc have variable bodies.
+REQUESTS = {
+    C.put: ('>II', lambda f: f[0] + f[1]),
+    C.putkeep: ('>II', lambda f: f[0] + f[1]),
+    C.putcat: ('>II', lambda f: f[0] + f[1]),
+    C.putnr: ('>II', lambda f: f[0] + f[1]),
+    C.putshl: ('>III', lambda f: f[0] + f[1]),
+    C.out: ('>I', lambda f: f[0]),
+    C.get: ('>I', lambda f: f[0]),
+    C.vsiz: ('>I', lambda f: f[0]),
+    C.copy: ('>I', lambda f: f[0]),
+    C.fwmkeys: ('>II', lambda f: f[0]),
+    C.addint: ('>II', lambda f: f[0]),
+    C.adddouble: ('>IQQ', lambda f: f[0]),
+    C.ext: ('>IIII', lambda f: f[0] + f[2] + f[3]),
+    C.restore: ('>IQ', lambda f: f[0]),
+    C.setmst: ('>II', lambda f: f[0]),
+    C.iterinit: ('', lambda f: 0),
+    C.iternext: ('', lambda f: 0),
+    C.sync: ('', lambda f: 0),
+    C.vanish: ('', lambda f: 0),
+    C.rnum: ('', lambda f: 0),
+    C.size: ('', lambda f: 0),
+    C.stat: ('', lambda f: 0),
+}
+
+
+class ReplayError(Exception):
+    pass
+
+
+class RecordingSocket(object):
+    """Socket wrapper passing everything sent to a Recorder
+    """
+    def __init__(self, sock, recorder, connection):
+        self.recorded_sock = sock
+        self.recorder = recorder
+        self.connection = connection
+
+    def sendall(self, data):
+        self.recorder.write(self.connection, data)
+        return self.recorded_sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.recorded_sock, name)
+
+
+class Recorder(object):
+    """Write the requests of attached connections to a capture file
+
+    Use Tyrant.record(recorder) to attach a connection. Recording is
+    thread-safe; every attached connection gets its own number.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.records = 0
+        self._connections = 0
+        self._lock = threading.Lock()
+        fileobj.write(CAPTURE_MAGIC)
+
+    def wrap(self, sock):
+        with self._lock:
+            self._connections += 1
+            connection = self._connections
+        return RecordingSocket(sock, self, connection)
+
+    def write(self, connection, data):
+        with self._lock:
+            self.fileobj.write(RECORD.pack(time.time(), connection,
+                                           len(data)))
+            self.fileobj.write(data)
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            self.fileobj.close()
+
+
+def iter_capture(fileobj):
+    """Iterate over the (time, connection, bytes) records of a capture
+    """
+    if fileobj.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise ReplayError('Not a capture file')
+    while True:
+        header = fileobj.read(RECORD.size)
+        if not header:
+            return
+        if len(header) < RECORD.size:
+            raise ReplayError('Truncated capture file')
+        timestamp, connection, length = RECORD.unpack(header)
+        data = fileobj.read(length)
+        if len(data) < length:
+            raise ReplayError('Truncated capture file')
+        yield timestamp, connection, data
+
+
+def _request_end(buf, pos):
+    """Return (command, end) of the request at pos, or None if buf ends
+    before it does
+    """
+    if len(buf) < pos + 2:
+        return None
+    magic, code = struct.unpack_from('>BB', buf, pos)
+    if magic != MAGIC:
+        raise ReplayError('Bad request magic 0x%x' % magic)
+    pos += 2
+    if code == C.mget:
+        if len(buf) < pos + 4:
+            return None
+        count, = struct.unpack_from('>I', buf, pos)
+        return _skip_strings(buf, pos + 4, count, 'mget')
+    if code == C.misc:
+        if len(buf) < pos + 12:
+            return None
+        nsiz, opts, count = struct.unpack_from('>III', buf, pos)
+        pos += 12
+        if len(buf) < pos + nsiz:
+            return None
+        name = 'misc:' + buf[pos:pos + nsiz]
+        return _skip_strings(buf, pos + nsiz, count, name)
+    if code not in REQUESTS:
+        raise ReplayError('Unknown command 0x%x' % code)
+    fmt, body = REQUESTS[code]
+    size = fmt and struct.calcsize(fmt) or 0
+    if len(buf) < pos + size:
+        return None
+    fields = fmt and struct.unpack_from(fmt, buf, pos) or ()
+    end = pos + size + body(fields)
+    if len(buf) < end:
+        return None
+    return COMMANDS[code], end
+
+
+def _skip_strings(buf, pos, count, name):
+    for i in xrange(count):
+        if len(buf) < pos + 4:
+            return None
+        length, = struct.unpack_from('>I', buf, pos)
+        pos += 4 + length
+    if len(buf) < pos:
+        return None
+    return name, pos
+
+
+def parse_requests(buf):
+    """Split buf into complete requests. Returns ([(command, bytes)], rest)
+    where rest is the beginning of an incomplete request.
+
+    >>> get = struct.pack('>BBI', MAGIC, C.get, 3) + 'foo'
+    >>> out = struct.pack('>BBI', MAGIC, C.out, 3) + 'bar'
+    >>> requests, rest = parse_requests(get + out + get[:5])
+    >>> [name for name, data in requests], requests[1][1] == out
+    (['get', 'out'], True)
+    >>> rest == get[:5]
+    True
+    >>> parse_requests(get[:-1]) == ([], get[:-1])
+    True
+    >>> parse_requests('x' + get)
+    Traceback (most recent call last):
+    ...
+    ReplayError: Bad request magic 0x78
+    """
+    requests = []
+    pos = 0
+    while pos < len(buf):
+        parsed = _request_end(buf, pos)
+        if parsed is None:
+            break
+        name, end = parsed
+        requests.append((name, buf[pos:end]))
+        pos = end
+    return requests, buf[pos:]
+
+
+class _BufferedSocket(object):
+    # sockrecv() only needs recv(); read through a buffered file instead of
+    # one system call per field
+    def __init__(self, sock):
+        self.f = sock.makefile('rb', 1 << 16)
+
+    def recv(self, size):
+        return self.f.read(size)
+
+
+def read_response(sock, name):
+    """Read the response to a request of type name; returns True if it
+    succeeded
+    """
+    if name == 'putnr':
+        return True
+    ok = not ord(sockrecv(sock, 1))
+    if name.startswith('misc:'):
+        # misc always sends the number of results
+        for i in xrange(socklen(sock)):
+            sockstr(sock)
+        return ok
+    if not ok:
+        return False
+    if name in ('get', 'iternext', 'ext', 'stat'):
+        sockstr(sock)
+    elif name == 'mget':
+        for i in xrange(socklen(sock)):
+            klen, vlen = struct.unpack('>II', sockrecv(sock, 8))
+            sockrecv(sock, klen + vlen)
+    elif name == 'fwmkeys':
+        for i in xrange(socklen(sock)):
+            sockstr(sock)
+    elif name in ('vsiz', 'addint'):
+        sockrecv(sock, 4)
+    elif name in ('rnum', 'size'):
+        sockrecv(sock, 8)
+    elif name == 'adddouble':
+        sockrecv(sock, 16)
+    return True
+
+
+class _Stats(object):
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, latency, ok):
+        self.latencies.setdefault(name, []).append(latency)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def _replay_worker(address, todo, stats, start, first, speed, failures):
+    try:
+        t = Tyrant.open(*address)
+    except Exception, e:
+        failures.append(e)
+        t = None
+    try:
+        reader = t and _BufferedSocket(t.sock)
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            if t is None or failures:
+                continue
+            timestamp, requests = job
+            if speed:
+                delay = start + (timestamp - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.time()
+            t.sock.sendall(''.join(data for name, data in requests))
+            for name, data in requests:
+                ok = read_response(reader, name)
+                stats.add(name, time.time() - sent, ok)
+    except Exception, e:
+        failures.append(e)
+        # Keep draining so the reader does not block
+        while todo.get() is not None:
+            pass
+    finally:
+        if t is not None:
+            t.close()
+
+
+def _percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def replay(fileobj, address, speed=1.0, connections=None, queue_size=1000):
+    """Replay a capture against the server at address (arguments of
+    Tyrant.open()).
+
+    speed : 1.0 is the captured pace, 2.0 twice as fast; None or 0 sends
+            every request as soon as the previous response arrived
+    connections : Number of connections; captured connections are spread
+                  over them (default=None => one per captured connection)
+
+    Returns (seconds, {command: results}) where results is a dict of
+    count, errors, rate (requests per second over the whole replay) and the
+    latency percentiles p50, p90, p99 and max in seconds.
+    """
+    workers = {}
+    failures = []
+    buffers = {}
+    start = time.time()
+    first = None
+    try:
+        for timestamp, connection, data in iter_capture(fileobj):
+            if failures:
+                break
+            if first is None:
+                first = timestamp
+            requests, buffers[connection] = parse_requests(
+                buffers.get(connection, '') + data)
+            if not requests:
+                continue
+            if connections:
+                slot = connection % connections
+            else:
+                slot = connection
+            worker = workers.get(slot)
+            if worker is None:
+                todo = Queue.Queue(queue_size)
+                stats = _Stats()
+                thread = threading.Thread(target=_replay_worker, args=(
+                    address, todo, stats, start, first, speed, failures))
+                thread.setDaemon(True)
+                thread.start()
+                worker = workers[slot] = (thread, todo, stats)
+            worker[1].put((timestamp, requests))
+    finally:
+        for thread, todo, stats in workers.values():
+            todo.put(None)
+        for thread, todo, stats in workers.values():
+            thread.join()
+    if failures:
+        raise failures[0]
+    elapsed = time.time() - start
+
+    latencies, errors = {}, {}
+    for thread, todo, stats in workers.values():
+        for name, samples in stats.latencies.iteritems():
+            latencies.setdefault(name, []).extend(samples)
+        for name, count in stats.errors.iteritems():
+            errors[name] = errors.get(name, 0) + count
+    results = {}
+    for name, samples in latencies.iteritems():
+        samples.sort()
+        results[name] = {
+            'count': len(samples),
+            'errors': errors.get(name, 0),
+            'rate': elapsed > 0 and len(samples) / elapsed or 0.0,
+            'p50': _percentile(samples, 0.5),
+            'p90': _percentile(samples, 0.9),
+            'p99': _percentile(samples, 0.99),
+            'max': samples[-1],
+        }
+    return elapsed, results
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] CAPTURE',
+        description='Replay a captured Tokyo Tyrant request log and report '
+                    'throughput and latency per command.')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=DEFAULT_PORT)
+    parser.add_option('--unix', metavar='PATH',
+                      help='connect to a UNIX domain socket instead')
+    parser.add_option('--speed', type='float', default=1.0,
+                      help='multiple of the captured pace (default 1.0)')
+    parser.add_option('--max-speed', action='store_true',
+                      help='send requests as fast as possible')
+    parser.add_option('--connections', type='int',
+                      help='number of connections (default: as captured)')
+    parser.add_option('--server', metavar='DBPATH',
+                      help='start a local ttserver with this database '
+                           "('*' for an on-memory hash database)")
+    parser.add_option('--exec-cmd', default=ttserver.TT_COMMAND,
+                      help='ttserver command for --server')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected one capture file')
+    if options.unix:
+        address = ('unix://' + options.unix,)
+    else:
+        address = (options.host, options.port)
+
+    server = None
+    if options.server:
+        server = ttserver.TokyoTyrant(ttserver.db_factory(options.server),
+                                     hostname=options.host, port=options.port,
+                                     socket_path=options.unix,
+                                     exec_cmd=options.exec_cmd)
+        server.run()
+    try:
+        if server is not None:
+            server.wait_ready()
+        f = open(args[0], 'rb')
+        try:
+            elapsed, results = replay(f, address,
+                                      None if options.max_speed
+                                      else options.speed,
+                                      options.connections)
+        finally:
+            f.close()
+    finally:
+        if server is not None:
+            server.stop()
+
+    print '%-16s %8s %6s %10s %9s %9s %9s %9s' % (
+        'command', 'count', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms',
+        'max ms')
+    for name in sorted(results):
+        r = results[name]
+        print '%-16s %8d %6d %10.0f %9.2f %9.2f %9.2f %9.2f' % (
+            name, r['count'], r['errors'], r['rate'], r['p50'] * 1e3,
+            r['p90'] * 1e3, r['p99'] * 1e3, r['max'] * 1e3)
+    total = sum(r['count'] for r in results.itervalues())
+    print '%d requests in %.2f s, %.0f req/s' % (
+        total, elapsed, elapsed > 0 and total / elapsed or 0.0)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
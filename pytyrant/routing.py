@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""Master/replica aware routing for the binary Tyrant protocol
+
+ReplicatedTyrant is a drop-in replacement for a Tyrant connection which knows
+about a ttserver replication setup (see the ``repl_master_host`` and
+``repl_master_port`` options of ttserver.TokyoTyrant). Updates are always sent
+to the master, while reads are spread over the replicas, weighted by their
+measured latency::
+
+    >>> from pytyrant.pytyrant import PyTyrant
+    >>> from pytyrant.routing import ReplicatedTyrant
+    >>> rt = ReplicatedTyrant(('10.0.0.1', 1978),
+    ...                       [('10.0.0.2', 1978), ('10.0.0.3', 1978)])
+    >>> t = PyTyrant(rt)
+    >>> t['foo'] = 'bar'    # goes to 10.0.0.1
+    >>> t['foo']            # pinned to the master, the write is recent
+    'bar'
+
+Replication is asynchronous, so a replica may briefly lag behind the master.
+To let a client read its own writes, every read issued within
+``read_your_writes`` seconds after a write by the same ReplicatedTyrant is
+pinned to the master. Set it to 0 to always read from the replicas.
+
+With ``hedge=True`` reads are hedged to cut tail latency: when the chosen
+server has not answered within the 95th percentile of the recently observed
+read latencies, the same request is sent to a second server and whichever
+answer arrives first is used. The connection of the slower server is drained
+in the background and returned for reuse. ``hedged_reads``, ``hedges_fired``
+and ``hedges_won`` count how often hedging was possible, how often the second
+request was sent and how often the second server answered first.
+
+"""
+import collections
+import Queue
+import random
+import socket
+import sys
+import threading
+import time
+
+from pytyrant import Tyrant, TyrantError
+
+__all__ = ['ReplicatedTyrant']
+
+# misc functions which only read from the database
+READ_MISC = frozenset(['get', 'getlist', 'search', 'range'])
+
+
+class Endpoint(object):
+    """A connection to one server plus its latency estimate
+    """
+    def __init__(self, address):
+        self.address = address
+        self.latency = None
+        self.down_until = 0
+        self.recorder = None
+        self._tyrant = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Endpoint %s:%s latency=%r>' % (self.address[0],
+                                                self.address[1], self.latency)
+
+    @property
+    def tyrant(self):
+        if self._tyrant is None:
+            self._tyrant = self._recorded(Tyrant.open(*self.address))
+        return self._tyrant
+
+    def checkout(self):
+        """Take the connection for exclusive use by another thread
+        """
+        with self._lock:
+            tyrant, self._tyrant = self._tyrant, None
+        if tyrant is None:
+            tyrant = Tyrant.open(*self.address)
+        return self._recorded(tyrant)
+
+    def record(self, recorder):
+        """Record the requests of this endpoint's connections, see
+        Tyrant.record
+        """
+        self.recorder = recorder
+        with self._lock:
+            if self._tyrant is not None:
+                self._recorded(self._tyrant)
+
+    def _recorded(self, tyrant):
+        # Connections checked out while recording was switched catch up here
+        if getattr(tyrant.sock, 'recorder', None) is not self.recorder:
+            tyrant.record(self.recorder)
+        return tyrant
+
+    def checkin(self, tyrant):
+        """Give back a connection taken with checkout()
+        """
+        with self._lock:
+            if self._tyrant is None:
+                self._tyrant = tyrant
+                return
+        tyrant.close()
+
+    def is_up(self, now):
+        return self.down_until <= now
+
+    def observe(self, elapsed, alpha):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += alpha * (elapsed - self.latency)
+
+    def mark_down(self, until):
+        self.down_until = until
+        self.discard()
+
+    def discard(self):
+        with self._lock:
+            tyrant, self._tyrant = self._tyrant, None
+        if tyrant is not None:
+            try:
+                tyrant.close()
+            except socket.error:
+                pass
+
+
+class WorkerPool(object):
+    """Daemon threads running the functions passed to submit()
+
+    A thread is started only when none is idle, so the number of threads
+    is the largest number of functions ever running at once.
+    """
+    def __init__(self):
+        self._jobs = Queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = 0
+        self._threads = 0
+
+    def submit(self, func):
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            else:
+                self._threads += 1
+                thread = threading.Thread(target=self._work,
+                                          args=(self._jobs,))
+                thread.setDaemon(True)
+                thread.start()
+            self._jobs.put(func)
+
+    def _work(self, jobs):
+        while True:
+            func = jobs.get()
+            if func is None:
+                return
+            try:
+                func()
+            finally:
+                with self._lock:
+                    # Threads of a stopped pool don't take new work
+                    if jobs is self._jobs:
+                        self._idle += 1
+
+    def stop(self):
+        """Let the threads exit once the submitted functions are done
+        """
+        with self._lock:
+            jobs, threads = self._jobs, self._threads
+            self._jobs, self._threads, self._idle = Queue.Queue(), 0, 0
+        for i in xrange(threads):
+            jobs.put(None)
+
+
+class ReplicatedTyrant(object):
+    """Route updates to the master and reads to the replicas
+
+    master : (host, port) of the master server
+    replicas : list of (host, port) of the replica servers
+    read_your_writes : seconds after a write during which reads go to the
+        master (default=1.0, 0 => Disabled)
+    master_reads : also use the master for reads (default=False)
+    retry_after : seconds a failed replica is skipped (default=5.0)
+    alpha : smoothing factor of the latency moving average (default=0.2)
+    hedge : send slow reads to a second server as well (default=False)
+    hedge_percentile : latency percentile after which a read is hedged
+        (default=0.95)
+    hedge_min_delay : lower bound of the hedging delay in seconds
+        (default=0.001)
+    hedge_samples : number of recent read latencies the delay is computed
+        from (default=256)
+    """
+    def __init__(self, master, replicas=(), read_your_writes=1.0,
+                 master_reads=False, retry_after=5.0, alpha=0.2, hedge=False,
+                 hedge_percentile=0.95, hedge_min_delay=0.001,
+                 hedge_samples=256):
+        self.master = Endpoint(master)
+        self.replicas = [Endpoint(address) for address in replicas]
+        self.read_your_writes = read_your_writes
+        self.master_reads = master_reads
+        self.retry_after = retry_after
+        self.alpha = alpha
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedged_reads = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self._samples = collections.deque(maxlen=hedge_samples)
+        self._pinned_until = 0
+        # Guards the latency estimates, samples and hedging counters, which
+        # the hedged read threads update too
+        self._lock = threading.Lock()
+        self._pool = WorkerPool()
+
+    def _candidates(self, now):
+        if now < self._pinned_until:
+            return []
+        candidates = [e for e in self.replicas if e.is_up(now)]
+        if self.master_reads:
+            candidates.append(self.master)
+        return candidates
+
+    def choose(self):
+        """Pick the endpoint for the next read
+
+        Endpoints are drawn with a probability inversely proportional to
+        their average latency. Endpoints without any measurement yet get the
+        best weight, so that every replica is probed early on.
+        """
+        candidates = self._candidates(time.time())
+        if not candidates:
+            return self.master
+        known = [e.latency for e in candidates if e.latency]
+        best = known and min(known) or 1.0
+        weights = [1.0 / (e.latency or best) for e in candidates]
+        point = random.random() * sum(weights)
+        for endpoint, weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
+                return endpoint
+        return candidates[-1]
+
+    def _alternative(self, endpoint):
+        """Pick the endpoint a read to endpoint is hedged to, or None
+        """
+        candidates = [e for e in self._candidates(time.time())
+                      if e is not endpoint]
+        if not candidates:
+            if endpoint is self.master:
+                return None
+            return self.master
+        return min(candidates, key=lambda e: (e.latency is None, e.latency))
+
+    def _observe(self, endpoint, elapsed):
+        with self._lock:
+            endpoint.observe(elapsed, self.alpha)
+            self._samples.append(elapsed)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def hedge_delay(self):
+        """Seconds to wait for an answer before hedging a read
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return self.hedge_min_delay
+        index = min(len(samples) - 1, int(len(samples) * self.hedge_percentile))
+        return max(self.hedge_min_delay, samples[index])
+
+    def _call(self, endpoint, name, args):
+        start = time.time()
+        try:
+            result = getattr(endpoint.tyrant, name)(*args)
+        except TyrantError:
+            # A negative answer is still an answer
+            self._observe(endpoint, time.time() - start)
+            raise
+        self._observe(endpoint, time.time() - start)
+        return result
+
+    def _attempt(self, endpoint, name, args, answers):
+        """Run one read in a thread of the worker pool and put the outcome,
+        a tuple of (endpoint, exc_info, result), into the answers queue.
+        """
+        def run():
+            start = time.time()
+            try:
+                tyrant = endpoint.checkout()
+            except socket.error:
+                answers.put((endpoint, sys.exc_info(), None))
+                return
+            try:
+                result = getattr(tyrant, name)(*args)
+            except TyrantError:
+                self._observe(endpoint, time.time() - start)
+                endpoint.checkin(tyrant)
+                answers.put((endpoint, sys.exc_info(), None))
+            except:
+                tyrant.close()
+                answers.put((endpoint, sys.exc_info(), None))
+            else:
+                self._observe(endpoint, time.time() - start)
+                endpoint.checkin(tyrant)
+                answers.put((endpoint, None, result))
+        self._pool.submit(run)
+
+    def _hedged_read(self, first, second, name, args):
+        answers = Queue.Queue()
+        launched = 1
+        failed = 0
+        timeout = self.hedge_delay()
+        self._count('hedged_reads')
+        self._attempt(first, name, args, answers)
+        while True:
+            try:
+                endpoint, exc_info, result = answers.get(True, timeout)
+            except Queue.Empty:
+                self._count('hedges_fired')
+                self._attempt(second, name, args, answers)
+                launched, timeout = 2, None
+                continue
+            if exc_info is not None and issubclass(exc_info[0], socket.error):
+                endpoint.mark_down(time.time() + self.retry_after)
+                failed += 1
+                if launched == 1:
+                    # Nothing to wait for, fail over right away
+                    self._attempt(second, name, args, answers)
+                    launched, timeout = 2, None
+                    continue
+                if failed < launched:
+                    continue
+            elif endpoint is second and launched == 2 and not failed:
+                self._count('hedges_won')
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return result
+
+    def _read(self, name, *args):
+        endpoint = self.choose()
+        if self.hedge:
+            alternative = self._alternative(endpoint)
+            if alternative is not None:
+                return self._hedged_read(endpoint, alternative, name, args)
+        if endpoint is self.master:
+            return self._call(endpoint, name, args)
+        try:
+            return self._call(endpoint, name, args)
+        except socket.error:
+            # The replica is unreachable, fall back to the master
+            endpoint.mark_down(time.time() + self.retry_after)
+            return self._call(self.master, name, args)
+
+    def _write(self, name, *args):
+        try:
+            return getattr(self.master.tyrant, name)(*args)
+        finally:
+            if self.read_your_writes:
+                self._pinned_until = time.time() + self.read_your_writes
+
+    def _master(self, name, *args):
+        return getattr(self.master.tyrant, name)(*args)
+
+    def address(self):
+        """Arguments of Tyrant.open() connecting to the master
+        """
+        return tuple(self.master.address)
+
+    def clone(self):
+        """A new ReplicatedTyrant with the same servers and settings
+        """
+        return self.__class__(
+            self.master.address, [e.address for e in self.replicas],
+            self.read_your_writes, self.master_reads, self.retry_after,
+            self.alpha, self.hedge, self.hedge_percentile,
+            self.hedge_min_delay, self._samples.maxlen)
+
+    def record(self, recorder):
+        """Log the requests sent to all servers to recorder, a
+        pytyrant.replay.Recorder; None stops recording. Every connection
+        is recorded as a connection of its own. Clones are not recorded.
+        """
+        self.master.record(recorder)
+        for endpoint in self.replicas:
+            endpoint.record(recorder)
+
+    def close(self):
+        self._pool.stop()
+        self.master.discard()
+        for endpoint in self.replicas:
+            endpoint.discard()
+
+    # reads
+
+    def get(self, key):
+        return self._read('get', key)
+
+    def mget(self, klst):
+        return self._read('mget', klst)
+
+    def vsiz(self, key):
+        return self._read('vsiz', key)
+
+    def fwmkeys(self, prefix, maxkeys):
+        return self._read('fwmkeys', prefix, maxkeys)
+
+    def vsiz_many(self, keys):
+        return self._read('vsiz_many', keys)
+
+    # writes
+
+    def put(self, key, value):
+        return self._write('put', key, value)
+
+    def putkeep(self, key, value):
+        return self._write('putkeep', key, value)
+
+    def putcat(self, key, value):
+        return self._write('putcat', key, value)
+
+    def putshl(self, key, value, width):
+        return self._write('putshl', key, value, width)
+
+    def putnr(self, key, value):
+        return self._write('putnr', key, value)
+
+    def out(self, key):
+        return self._write('out', key)
+
+    def addint(self, key, num):
+        return self._write('addint', key, num)
+
+    def adddouble(self, key, num):
+        return self._write('adddouble', key, num)
+
+    def ext(self, func, opts, key, value):
+        return self._write('ext', func, opts, key, value)
+
+    def vanish(self):
+        return self._write('vanish')
+
+    def restore(self, path, msec):
+        return self._write('restore', path, msec)
+
+    def put_from(self, key, fileobj, length):
+        return self._write('put_from', key, fileobj, length)
+
+    def misc(self, func, opts, args):
+        if func in READ_MISC:
+            return self._read('misc', func, opts, args)
+        return self._write('misc', func, opts, args)
+
+    # master only: stateful iteration and administrative commands, split
+    # requests whose answer has to be read from the same connection, and
+    # streamed reads, which can neither be hedged nor retried once part of
+    # the value has been written out
+
+    def iterinit(self):
+        return self._master('iterinit')
+
+    def iternext(self):
+        return self._master('iternext')
+
+    def iternext_many(self, count):
+        return self._master('iternext_many', count)
+
+    def _misc_send(self, func, opts, args):
+        return self._master('_misc_send', func, opts, args)
+
+    def _misc_recv(self):
+        return self._master('_misc_recv')
+
+    def get_into(self, key, writable):
+        return self._master('get_into', key, writable)
+
+    def sync(self):
+        return self._master('sync')
+
+    def copy(self, path):
+        return self._master('copy', path)
+
+    def setmst(self, host, port):
+        return self._master('setmst', host, port)
+
+    def rnum(self):
+        return self._master('rnum')
+
+    def size(self):
+        return self._master('size')
+
+    def stat(self):
+        return self._master('stat')
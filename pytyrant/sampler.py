@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Periodic sampling of Tokyo Tyrant server statistics
+
+The ``stat`` command only returns a snapshot of the server counters. The
+StatsSampler polls it on an interval from a background thread, keeps the
+most recent samples in a fixed-size ring buffer and derives rates from
+them: operations per second from the ``cnt_*`` counters, record and file
+growth from ``rnum`` and ``size``, and the replication ``delay``::
+
+    >>> from pytyrant.pytyrant import PyTyrant
+    >>> from pytyrant.sampler import StatsSampler
+    >>> t = PyTyrant.open('127.0.0.1', 1978)
+    >>> sampler = StatsSampler(t, interval=5.0)
+    >>> sampler.start()
+    >>> sampler.rates()['cnt_get']      # gets per second
+    1523.4
+    >>> sampler.stop()
+
+The sampler uses its own connection, so the source can be used by other
+threads in the meantime.
+
+"""
+import collections
+import threading
+import time
+
+from pytyrant import Tyrant, get_tyrant_stats
+
+__all__ = ['Sample', 'StatsSampler']
+
+
+class Sample(object):
+    """Server statistics at one point in time
+
+    Numeric statistics are converted to int or float, everything else is
+    kept as a string.
+    """
+    def __init__(self, stats, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.time = timestamp
+        self.stats = {}
+        for k, v in stats.iteritems():
+            try:
+                self.stats[k] = int(v)
+            except ValueError:
+                try:
+                    self.stats[k] = float(v)
+                except ValueError:
+                    self.stats[k] = v
+
+    def __repr__(self):
+        return '<Sample %s rnum=%s size=%s>' % (self.time,
+            self.stats.get('rnum'), self.stats.get('size'))
+
+    def __getitem__(self, key):
+        return self.stats[key]
+
+    def get(self, key, default=None):
+        return self.stats.get(key, default)
+
+
+class StatsSampler(object):
+    """Poll server statistics in a background thread
+
+    source : Tyrant, PyTyrant, ttserver.TokyoTyrant or (host, port)
+    interval : seconds between two samples (default=1.0)
+    size : number of samples kept (default=3600)
+    callback : called with every new Sample from the sampling thread
+    """
+    def __init__(self, source, interval=1.0, size=3600, callback=None):
+        self.source = source
+        self.interval = interval
+        self.callback = callback
+        self.samples = collections.deque(maxlen=size)
+        self.errors = 0
+        self._t = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _connect(self):
+        source = self.source
+        if hasattr(source, 't'):
+            source = source.t
+        if isinstance(source, Tyrant):
+            return source.clone()
+        if hasattr(source, 'endpoint'):
+            # ttserver.TokyoTyrant
+            return Tyrant.open(*source.endpoint())
+        return Tyrant.open(*source)
+
+    def sample(self):
+        """Take one sample now, store and return it
+        """
+        if self._t is None:
+            self._t = self._connect()
+        stats = get_tyrant_stats(self._t)
+        if 'rnum' not in stats:
+            stats['rnum'] = self._t.rnum()
+        if 'size' not in stats:
+            stats['size'] = self._t.size()
+        sample = Sample(stats)
+        self.samples.append(sample)
+        if self.callback is not None:
+            self.callback(sample)
+        return sample
+
+    def _run(self):
+        while not self._stopped.isSet():
+            started = time.time()
+            try:
+                self.sample()
+            except Exception:
+                # Keep sampling, reconnecting on the next round
+                self.errors += 1
+                self._close()
+            self._stopped.wait(max(0, self.interval - (time.time() - started)))
+        self._close()
+
+    def _close(self):
+        if self._t is not None:
+            try:
+                self._t.close()
+            finally:
+                self._t = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest(self):
+        return self.samples and self.samples[-1] or None
+
+    def series(self, key):
+        """List of (time, value) for one statistic
+        """
+        return [(s.time, s.stats[key]) for s in self.samples
+                if key in s.stats]
+
+    def deltas(self, window=None):
+        """Change of every numeric statistic over the last window seconds
+        (default=all samples) as a (seconds, {key: delta}) tuple
+        """
+        first, last = self._window(window)
+        if first is None:
+            return 0.0, {}
+        result = {}
+        for k, v in last.stats.iteritems():
+            old = first.stats.get(k)
+            if isinstance(v, (int, long, float)) and \
+                    isinstance(old, (int, long, float)):
+                result[k] = v - old
+        return last.time - first.time, result
+
+    def rates(self, window=None):
+        """Per second rates of the cnt_* counters and of rnum and size over
+        the last window seconds (default=all samples). The current
+        replication delay is included as is.
+        """
+        elapsed, deltas = self.deltas(window)
+        result = {}
+        if elapsed > 0:
+            for k, v in deltas.iteritems():
+                if k.startswith('cnt_') or k in ('rnum', 'size'):
+                    result[k] = v / elapsed
+        last = self.latest()
+        if last is not None and 'delay' in last.stats:
+            result['delay'] = last.stats['delay']
+        return result
+
+    def _window(self, window):
+        samples = list(self.samples)
+        if len(samples) < 2:
+            return None, None
+        last = samples[-1]
+        if window is None:
+            return samples[0], last
+        for sample in samples:
+            if last.time - sample.time <= window:
+                if sample is last:
+                    return samples[-2], last
+                return sample, last
+        return samples[-2], last
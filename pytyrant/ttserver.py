@@ -48,11 +48,17 @@ CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE."""
 
+import copy
 import logging
+import math
 import os
 import signal
+import socket
 import subprocess
 import sys
+import time
+
+from pytyrant import Tyrant
 
 log = logging.getLogger('tokyotyrant')
 
@@ -81,6 +87,7 @@ class TTDatabase(object):
 
     def __init__(self, dbpath, **opts):
         self.dbpath = dbpath
+        self.dbopts = {}
         self._assert_dbpath()
         for opt,opt_val in opts.iteritems():
             if opt == 'mode' and opt_val:
@@ -108,6 +115,18 @@ class TTDatabase(object):
                                                           self.dbpath_ext, self.dbpath)
         raise ValueError, msg
 
+    def clone(self, dbpath=None):
+        """Return a copy of this database, optionally stored at dbpath"""
+        db = copy.copy(self)
+        db.dbopts = dict(self.dbopts)
+        if dbpath is not None:
+            db.dbpath = dbpath
+            db._assert_dbpath()
+        return db
+
+    def is_memory(self):
+        return self.dbpath in ('*', '+')
+
     def to_cmd(self):
         arg = self.dbpath
         opts = self.opts_to_cmd()
@@ -116,7 +135,7 @@ class TTDatabase(object):
         return arg
 
     def opts_to_cmd(self):
-        return '#'.join(['%s=%s' % (k, v) for k,v in self.dbopts.iteritems()
+        return '#'.join(['%s=%s' % (k, v) for k,v in sorted(self.dbopts.iteritems())
                                             if v is not None])
 
 class TTMemHashDB(TTDatabase):
@@ -213,7 +232,7 @@ class TTTableDB(TTDatabase):
     dbpath_ext = 'tct'
 
     def __init__(self, dbpath, mode=None, bnum=None, apow=None, fpow=None, opts=None,
-                 rcnum=None, lcnum=None, xmsiz=None, idx=None, dfunit=None):
+                 rcnum=None, lcnum=None, ncnum=None, xmsiz=None, idx=None, dfunit=None):
         """
         mode : File mode. See TT_FILE_MODES.
         bnum: Number of hash buckets. (default=131071)
@@ -250,6 +269,137 @@ def db_factory(dbpath, *args, **kw):
     return db_cls(dbpath, *args, **kw)
 
 
+# Approximate per record overhead of Tokyo Cabinet in bytes
+_RECORD_OVERHEAD = 24
+_LARGE_FILE = 1 << 31
+
+# Options set by tune_database, all others are kept by retune_database
+_TUNED_OPTS = frozenset(['bnum', 'apow', 'lmemb', 'nmemb', 'lcnum', 'ncnum',
+                         'rcnum', 'xmsiz'])
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+def _pow2(value):
+    return 1 << int(round(math.log(max(value, 1), 2)))
+
+def tune_database(dbpath, records, key_size, value_size, memory=None,
+                  read_ratio=0.5, **kw):
+    """Return a TTDatabase for dbpath with tuning parameters computed from
+    the expected workload.
+
+    dbpath : Database path, the type is derived from it as in db_factory
+    records : Expected number of records
+    key_size : Average key size in bytes
+    value_size : Average value size in bytes (for tables the whole record)
+    memory : Memory budget of the server in bytes (default=None => only
+             size the on-disk structures)
+    read_ratio : Share of reads in the workload, from 0.0 to 1.0
+    kw : Further database options, e.g. mode or opts
+
+    >>> tune_database('/tmp/a.tch', 10000000, 16, 100).to_cmd()
+    '/tmp/a.tch#apow=4#bnum=20000000'
+    >>> tune_database('/tmp/a.tch', 10000000, 16, 100, memory=2 << 30,
+    ...               read_ratio=0.9).to_cmd()
+    '/tmp/a.tch#apow=4#bnum=20000000#rcnum=4558337#xmsiz=1181116007'
+    >>> tune_database('/tmp/a.tcb', 10000000, 16, 100, memory=1 << 30,
+    ...               read_ratio=0.2).to_cmd()
+    '/tmp/a.tcb#bnum=78430#lcnum=23967#lmemb=256#ncnum=512#nmemb=256'
+    >>> tune_database('/tmp/a.tct', 50000000, 12, 300, memory=8 << 30).to_cmd()
+    '/tmp/a.tct#apow=6#bnum=100000000#lcnum=104857#ncnum=26214#opts=l#rcnum=4737096#xmsiz=5798205850'
+    >>> tune_database('*', 1000000, 16, 100).to_cmd()
+    '*#bnum=2000000'
+    """
+    db = db_factory(dbpath, **kw)
+    record_size = key_size + value_size
+    read_ratio = _clamp(read_ratio, 0.0, 1.0)
+    opts = {}
+
+    if isinstance(db, (TTHashDB, TTTableDB, TTMemHashDB)):
+        # Tokyo Cabinet suggests 0.5 to 4 buckets per record
+        opts['bnum'] = max(2 * records, 131071)
+        if isinstance(db, TTMemHashDB):
+            db.dbopts.update(opts)
+            return db
+        # Keep the alignment padding at a fraction of the record size
+        opts['apow'] = _clamp(int(math.log(record_size, 2)) - 2, 4, 10)
+        file_size = (records * (record_size + _RECORD_OVERHEAD) +
+                     opts['bnum'] * 4)
+        large = file_size > _LARGE_FILE
+        if large:
+            file_size += opts['bnum'] * 4
+            if 'l' not in (db.opts or ''):
+                opts['opts'] = (db.opts or '') + 'l'
+        if memory:
+            cache = 0
+            if isinstance(db, TTTableDB):
+                # Leave room for the column indexes (B+ trees)
+                index = memory // 10
+                opts['lcnum'] = max(1024, index // 8192)
+                opts['ncnum'] = max(512, opts['lcnum'] // 4)
+                memory -= index
+            if read_ratio:
+                cache = int(memory * read_ratio / 2)
+                opts['rcnum'] = cache // (record_size + 4 * _RECORD_OVERHEAD)
+            opts['xmsiz'] = min(file_size, memory - cache)
+
+    elif isinstance(db, TTBTreeDB):
+        # Small leaves are faster to search, large leaves split less often
+        leaf_size = 8192 * 4 ** (1 - read_ratio)
+        opts['lmemb'] = _clamp(_pow2(leaf_size / record_size), 8, 1024)
+        opts['nmemb'] = 256
+        leaves = records // opts['lmemb'] + 1
+        # Tokyo Cabinet suggests 1 to 4 buckets per page
+        opts['bnum'] = max(2 * (leaves + leaves // opts['nmemb']), 32749)
+        if records * (record_size + _RECORD_OVERHEAD) > _LARGE_FILE:
+            if 'l' not in (db.opts or ''):
+                opts['opts'] = (db.opts or '') + 'l'
+        if memory:
+            leaf_bytes = opts['lmemb'] * (record_size + _RECORD_OVERHEAD)
+            opts['ncnum'] = max(512, 2 * (leaves // opts['nmemb']))
+            opts['lcnum'] = max(1024, int(memory * 0.8) // leaf_bytes)
+
+    else:
+        raise ValueError, "Unable to tune database of type %s" % db.__class__
+
+    db.dbopts.update(opts)
+    return db
+
+def retune_database(db, stats, growth=1.0, memory=None, read_ratio=0.5):
+    """Recommend new tuning parameters for a running database.
+
+    db : The TTDatabase the server was started with
+    stats : Server statistics as returned by pytyrant.get_tyrant_stats
+    growth : Expected growth factor of the record count
+    memory, read_ratio : See tune_database
+
+    Returns a tuned copy of db if its bucket number is off by more than a
+    factor of 4 from the recommended one, otherwise None. Options that are
+    not tuning parameters, like mode, opts or dfunit, are kept.
+
+    >>> db = TTHashDB('/tmp/x.tch', opts='d', mode='wc', dfunit=8, bnum=1000)
+    >>> retune_database(db, {'rnum': '50000000',
+    ...                      'size': '10000000000'}).to_cmd()
+    '/tmp/x.tch#apow=5#bnum=100000000#dfunit=8#mode=wc#opts=dl'
+    >>> db = TTHashDB('/tmp/x.tch', mode='w', bnum=2000000)
+    >>> retune_database(db, {'rnum': '1000000', 'size': '200000000'}) is None
+    True
+    """
+    records = int(stats['rnum'])
+    size = int(stats['size'])
+    record_size = records and max(1, size // records - _RECORD_OVERHEAD) or 1
+    kw = dict((opt, value) for opt, value in db.dbopts.iteritems()
+              if value is not None and opt not in _TUNED_OPTS)
+    tuned = tune_database(db.dbpath, int(records * growth), 0, record_size,
+                          memory=memory, read_ratio=read_ratio, **kw)
+    bnum, wanted = db.dbopts.get('bnum'), tuned.dbopts.get('bnum')
+    if wanted is None:
+        return None
+    if bnum is None or not wanted // 4 <= bnum <= wanted * 4:
+        return tuned
+    return None
+
+
 
 class TokyoTyrant(object):
     """Convenience wrapper around Tokyo Tyrant for easy configuration and
@@ -261,7 +411,8 @@ class TokyoTyrant(object):
                  ulog_async=False, serverid=None, repl_master_host=None,
                  repl_master_port=None, repl_ts_path=None, lua_ext=None,
                  lua_cron_cmd=None, lua_cron_period=60, cmds_forbidden=None,
-                 cmds_allowed=None, exec_cmd = TT_COMMAND):
+                 cmds_allowed=None, exec_cmd = TT_COMMAND, cpu_affinity=None,
+                 socket_path=None):
         if not isinstance(db, TTDatabase):
             raise TypeError, "db must be a TTDatabase instance"
         self.db = db
@@ -286,9 +437,16 @@ class TokyoTyrant(object):
         self.cmds_forbidden = cmds_forbidden
         self.cmds_allowed = cmds_allowed
         self.exec_cmd = exec_cmd
+        self.cpu_affinity = cpu_affinity
+        # ttserver listens on a UNIX domain socket at host with port 0
+        self.socket_path = socket_path
 
     def to_cmd(self):
         args = [self.exec_cmd]
+        if self.cpu_affinity:
+            # Pin the server to the given CPUs (Linux only)
+            args[:0] = ['taskset', '-c',
+                        ','.join([str(c) for c in self.cpu_affinity])]
 
         def _add_arg(attr, arg, flag=False):
             if attr is None:
@@ -300,8 +458,12 @@ class TokyoTyrant(object):
             else:
                 args.extend((arg, str(attr)))
 
-        _add_arg(self.hostname, 'host')
-        _add_arg(self.port, 'port')
+        if self.socket_path:
+            _add_arg(self.socket_path, 'host')
+            _add_arg(0, 'port')
+        else:
+            _add_arg(self.hostname, 'host')
+            _add_arg(self.port, 'port')
         _add_arg(self.numthreads, 'thnum')
         _add_arg(self.pidfile, 'pid')
         _add_arg(self.pidfile_kill, 'kl', True)
@@ -366,6 +528,141 @@ class TokyoTyrant(object):
         os.kill(self._proc.pid, signal.SIGTERM)
         self.wait()
 
+    def endpoint(self):
+        """(host, port) to connect a client to"""
+        if self.socket_path:
+            return ('unix://' + os.path.abspath(self.socket_path), 0)
+        return (self.hostname or '127.0.0.1', self.port)
+
+    def wait_ready(self, timeout=10.0, interval=0.05):
+        """Wait until the server answers a stat command over the binary
+        protocol. Raises RuntimeError if the process exits or the server
+        is not ready after timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                t = Tyrant.open(*self.endpoint())
+                try:
+                    t.stat()
+                finally:
+                    t.close()
+                return
+            except socket.error:
+                pass
+            # poll() is False without a process; 0 == False, so compare
+            # by identity to catch a clean exit too
+            rc = self.poll()
+            if rc is not None and rc is not False:
+                raise RuntimeError('ttserver on %s:%s exited with %s' %
+                                   (self.endpoint() + (rc,)))
+            if time.time() > deadline:
+                raise RuntimeError('ttserver on %s:%s not ready after %ss' %
+                                   (self.endpoint() + (timeout,)))
+            time.sleep(interval)
+
+
+class TokyoTyrantCluster(object):
+    """Run several ttserver instances configured from one database template.
+
+    Every instance gets its own port (base_port + n) and, below base_dir, its
+    own directory holding the database file, the pid file and the update log.
+
+    Example:
+
+    >> db = ttserver.TTHashDB('/var/tt/data.tch', bnum=4000000)
+    >> cluster = ttserver.TokyoTyrantCluster(db, 4, '/var/tt', ulog=True,
+    ..                                       cpu_affinity=True)
+    >> cluster.run()
+    >> cluster.endpoints()
+    [('127.0.0.1', 1978), ('127.0.0.1', 1979), ('127.0.0.1', 1980),
+     ('127.0.0.1', 1981)]
+    """
+
+    def __init__(self, db, count, base_dir=None, hostname=None,
+                 base_port=1978, ulog=False, cpu_affinity=None,
+                 unix_sockets=False, **kw):
+        """
+        db : TTDatabase used as template for every instance
+        count : Number of instances
+        base_dir : Directory for instance data (default=directory of db)
+        hostname : Host every instance binds to
+        base_port : Port of the first instance
+        ulog : Keep an update log per instance
+        unix_sockets : Listen on a UNIX domain socket in the instance
+                       directory instead of a TCP port
+        cpu_affinity : True to pin each instance to its own CPU, or a list
+                       with a list of CPUs per instance (default=None)
+        kw : Further TokyoTyrant options shared by all instances
+        """
+        if not isinstance(db, TTDatabase):
+            raise TypeError, "db must be a TTDatabase instance"
+        if base_dir is None:
+            base_dir = os.path.dirname(os.path.abspath(db.dbpath))
+        self.db = db
+        self.base_dir = base_dir
+        if cpu_affinity is True:
+            ncpus = os.sysconf('SC_NPROCESSORS_ONLN')
+            cpu_affinity = [[n % ncpus] for n in xrange(count)]
+        self.servers = []
+        for n in xrange(count):
+            instance_dir = self.instance_dir(n)
+            if db.is_memory():
+                instance_db = db.clone()
+            else:
+                instance_db = db.clone(os.path.join(instance_dir,
+                                               os.path.basename(db.dbpath)))
+            self.servers.append(TokyoTyrant(instance_db, hostname=hostname,
+                port=base_port + n,
+                pidfile=os.path.join(instance_dir, 'ttserver.pid'),
+                ulog_path=ulog and os.path.join(instance_dir, 'ulog') or None,
+                cpu_affinity=cpu_affinity and cpu_affinity[n] or None,
+                socket_path=unix_sockets and
+                            os.path.join(instance_dir, 'ttserver.sock') or None,
+                **kw))
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def instance_dir(self, n):
+        return os.path.join(self.base_dir, str(n))
+
+    def run(self, wait_ready=True, timeout=10.0):
+        """Start all instances and, by default, wait until all of them
+        answer requests."""
+        for tt in self.servers:
+            for path in (os.path.dirname(tt.pidfile), tt.ulog_path):
+                if path and not os.path.isdir(path):
+                    os.makedirs(path)
+            tt.run()
+        if wait_ready:
+            self.wait_ready(timeout)
+
+    def wait_ready(self, timeout=10.0):
+        deadline = time.time() + timeout
+        for tt in self.servers:
+            tt.wait_ready(max(0, deadline - time.time()))
+
+    def poll(self):
+        return [tt.poll() for tt in self.servers]
+
+    def restart(self):
+        for tt in self.servers:
+            tt.restart()
+
+    def stop(self):
+        for tt in self.servers:
+            os.kill(tt._proc.pid, signal.SIGTERM)
+        for tt in self.servers:
+            tt.wait()
+
+    def endpoints(self):
+        """List of (host, port) of all instances, e.g. for a sharded or
+        pooled client"""
+        return [tt.endpoint() for tt in self.servers]
+
 
 
 
@@ -3,7 +3,7 @@
 from distutils.core import setup
 from pytyrant import __version__
 
-VERSION = __version___
+VERSION = __version__
 DESCRIPTION = "Pure python client implementation of the Tokyo Tyrant protocol"
 LONG_DESCRIPTION = """
 pytyrant is a pure python client implementation of the binary Tokyo Tyrant
@@ -40,5 +40,7 @@ setup(
     url="http://code.google.com/p/pytyrant/",
     license="MIT License",
     packages=['pytyrant'],
+    scripts=['scripts/pytyrant-dump', 'scripts/pytyrant-load',
+             'scripts/pytyrant-replay'],
     platforms=['any'],
 )